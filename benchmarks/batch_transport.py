@@ -0,0 +1,64 @@
+"""Benchmark passing triad data from a worker process through shared memory slots against a plain queue
+
+    $python -m benchmarks.batch_transport --n_data 100 --n_triads 8000
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from src.batch_transport import SharedSlots
+from src.build_data import MAXLEN
+
+
+def make_datum(n_triads):
+    """a dense triad datum: 9 distance and speaker inputs, 6 word and pos inputs, labels"""
+    X = [np.zeros((n_triads, 1), dtype=np.int64) for _ in range(9)]
+    X += [np.random.randint(0, 1000, (n_triads, MAXLEN)).astype(np.int32) for _ in range(6)]
+    return [X, np.zeros((n_triads, 3), dtype=np.int64)]
+
+
+def transfer(datum, n_data, slots=None, held=4):
+    """seconds to receive n_data copies of datum. The consumer holds `held` data before releasing them"""
+    out_q = multiprocessing.Queue(maxsize=200)
+
+    def worker():
+        for _ in range(n_data):
+            out_q.put(slots.pack(datum) if slots is not None else datum)
+
+    process = multiprocessing.Process(target=worker)
+    process.daemon = True
+    start = time.time()
+    process.start()
+    n_shared = 0
+    for _ in range(n_data):
+        message = out_q.get()
+        if slots is not None:
+            n_shared += message[0] == 'slot'
+            slots.unpack(message)
+            if len(slots.held) >= held:
+                slots.release()
+    elapsed = time.time() - start
+    process.join()
+    return elapsed, n_shared
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_data", default=100, type=int, help="number of data to pass")
+    parser.add_argument("--n_triads", default=8000, type=int, help="triads per datum")
+    args = parser.parse_args()
+
+    datum = make_datum(args.n_triads)
+    print("datum size: %.1f MB" % (sum(x.nbytes for x in datum[0]) / 1e6))
+    queue_time, _ = transfer(datum, args.n_data)
+    print("queue: %.2fs" % queue_time)
+    slots_time, n_shared = transfer(datum, args.n_data, slots=SharedSlots(8))
+    print("shared slots: %.2fs, %d/%d data through shared memory" % (slots_time, n_shared, args.n_data))
+    print("speedup: %.1fx" % (queue_time / slots_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Benchmark the streaming conll reader against get_df + DataFrame.append
+
+    $python -m benchmarks.conll_parser --n_docs 10000
+"""
+from __future__ import print_function
+import argparse
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from src.conll_reader import read_conll_files
+from benchmarks.synthetic import write_corpus
+
+
+def get_df(data_file, n_fields=12):
+    """what build_dataFrame used to parse each file with: a data frame of its token lines"""
+    data_list = []
+    with open(data_file) as f:
+        for line in f:
+            line = line.strip()
+            if line and line[0] != '#':
+                fields = line.split()
+                assert len(fields) >= n_fields, fields
+                data_list.append(fields[:11] + [fields[-1]])
+    if not data_list:
+        return None
+
+    columns = ['file_id', 'part_nb', 'word_nb', 'word', 'pos', 'parse', 'predicate_lemma',
+               'predicate_frame', 'word_sense', 'speaker', 'name_entities', 'coref']
+    new_data = pd.DataFrame(data_list, columns=columns)
+    new_data.insert(loc=0, column='doc_id', value=new_data["file_id"] + '-' + new_data["part_nb"].map(str))
+    return new_data.drop(['part_nb'], axis=1)
+
+
+def append(df, new_data):
+    if hasattr(df, 'append'):
+        return df.append(new_data)
+    return pd.concat([df, new_data])  # DataFrame.append was removed in pandas 2
+
+
+def legacy_build(data_files, batch=10):
+    """what build_dataFrame used to do, in a single process"""
+    df = None
+    new_data = None
+    for i, data_file in enumerate(data_files):
+        item = get_df(data_file)
+        new_data = item if new_data is None else append(new_data, item)
+        if (i + 1) % batch == 0 or i + 1 == len(data_files):
+            df = new_data if df is None else append(df, new_data)
+            new_data = None
+            len(df.file_id.unique())
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_docs", default=10000, type=int, help="number of synthetic documents")
+    parser.add_argument("--tokens_per_doc", default=200, type=int, help="tokens per document")
+    parser.add_argument("--skip_legacy", action='store_true', default=False, help="only time the new reader")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        data_files = write_corpus(root, n_docs=args.n_docs, tokens_per_doc=args.tokens_per_doc)
+        print("%d documents in %d files" % (args.n_docs, len(data_files)))
+
+        start = time.time()
+        df = read_conll_files(data_files)
+        new_time = time.time() - start
+        print("streaming reader: %.2fs, %d tokens" % (new_time, len(df)))
+
+        if not args.skip_legacy:
+            start = time.time()
+            legacy_df = legacy_build(data_files)
+            legacy_time = time.time() - start
+            print("get_df + append: %.2fs, %d tokens" % (legacy_time, len(legacy_df)))
+            assert (legacy_df.values == df.values).all()
+            print("speedup: %.1fx" % (legacy_time / new_time))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
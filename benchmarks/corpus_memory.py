@@ -0,0 +1,76 @@
+"""Compare the memory used by the corpus representations
+
+Each representation is built in a fresh process. Peak is the high water mark of resident
+memory above the baseline after imports; retained is what is still resident once
+intermediate data has been freed.
+
+    $python -m benchmarks.corpus_memory --n_docs 10000
+"""
+from __future__ import print_function
+import argparse
+import ctypes
+import gc
+import multiprocessing
+import shutil
+import tempfile
+
+
+def read_status(field):
+    """value in MB of a field of /proc/self/status, e.g. VmRSS"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024.
+    raise KeyError(field)
+
+
+def build(representation, data_files, result_q):
+    from benchmarks.conll_parser import legacy_build
+    from src.conll_reader import ConllColumns, get_frame
+    from src.compact_corpus import CompactCorpus
+
+    baseline = read_status('VmRSS')
+    if representation == 'legacy':
+        corpus = legacy_build(data_files)
+    else:
+        columns = ConllColumns()
+        for data_file in data_files:
+            columns.add_file(data_file)
+        arrays = columns.get_arrays()
+        if representation == 'frame':
+            corpus = get_frame(arrays, columns.files)
+        else:
+            corpus = CompactCorpus(arrays)
+        del columns, arrays
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)  # give freed heap pages back to the OS
+    except (OSError, AttributeError):
+        pass
+    result_q.put((read_status('VmHWM') - baseline, read_status('VmRSS') - baseline, len(corpus)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_docs", default=10000, type=int, help="number of synthetic documents")
+    parser.add_argument("--tokens_per_doc", default=200, type=int, help="tokens per document")
+    args = parser.parse_args()
+
+    from benchmarks.synthetic import write_corpus
+    root = tempfile.mkdtemp()
+    try:
+        data_files = write_corpus(root, n_docs=args.n_docs, tokens_per_doc=args.tokens_per_doc)
+        context = multiprocessing.get_context('spawn')
+        result_q = context.Queue()
+        for representation in ('legacy', 'frame', 'compact'):
+            p = context.Process(target=build, args=(representation, data_files, result_q))
+            p.start()
+            peak, retained, size = result_q.get()
+            p.join()
+            print("%-8s peak RSS +%7.1f MB, retained +%7.1f MB (%d)" % (representation, peak, retained, size))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark the vectorized get_entities against the row by row version, and check that both, and the
+entities of a compact corpus, are the same
+
+    $python -m benchmarks.entity_extraction --n_docs 2000
+"""
+from __future__ import print_function
+import argparse
+import re
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from src.build_data import get_entities, get_span_entities
+from src.compact_corpus import CompactCorpus
+from src.conll_reader import read_conll_files
+from src.document_store import DocumentStore
+from benchmarks.synthetic import write_corpus
+
+
+# mentions opening on the same token, like nested noun phrases: their order decides the order of the entities
+NESTED_COREF = ['(1|(2', '-', '2)', '(3', '-', '1)|3)', '(4)|(5', '-', '5)', '(6|(7)', '6)', '(2)']
+
+
+def nested_document(doc_id='bn/syn/99/nested_0000-0'):
+    """data frame of a document with nested mentions"""
+    n = len(NESTED_COREF)
+    return pd.DataFrame({'doc_id': [doc_id] * n, 'file_id': [doc_id.rsplit('-', 1)[0]] * n,
+                         'word_nb': [str(i) for i in range(n)], 'word': ['the'] * n, 'pos': ['DT'] * n,
+                         'speaker': ['-'] * n, 'name_entities': ['*'] * n, 'coref': NESTED_COREF})
+
+
+def legacy_get_entities(df):
+    """what get_entities used to do: df.iloc and two regexes per token"""
+    coref_entities = {}
+    prefix = re.compile(r'\(\d+')
+    suffix = re.compile(r'\d+\)')
+    for i in range(len(df)):
+        coref = df.iloc[i].coref
+        for item in prefix.findall(coref):
+            coref_id = df.iloc[i].doc_id + '-' + item[1:]
+            if coref_id in coref_entities:
+                coref_entities[coref_id]['stack'].append(i)
+            else:
+                coref_entities[coref_id] = {'start': [], 'end': [], 'stack': [i]}
+        for item in suffix.findall(coref):
+            coref_id = df.iloc[i].doc_id + '-' + item[:-1]
+            coref_entities[coref_id]['end'].append(i)
+            coref_entities[coref_id]['start'].append(coref_entities[coref_id]['stack'].pop())
+    return coref_entities
+
+
+def time_documents(function, documents):
+    start = time.time()
+    results = [function(documents.get(doc_id)) for doc_id in documents]
+    return time.time() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_docs", default=2000, type=int, help="number of synthetic documents")
+    parser.add_argument("--tokens_per_doc", default=200, type=int, help="tokens per document")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        data_files = write_corpus(root, n_docs=args.n_docs, tokens_per_doc=args.tokens_per_doc)
+        df = read_conll_files(data_files)
+        documents = DocumentStore(pd.concat([df, nested_document()], ignore_index=True))
+    finally:
+        shutil.rmtree(root)
+    print("%d documents, %d tokens" % (len(documents), len(documents.df)))
+
+    new_time, new_results = time_documents(get_entities, documents)
+    print("vectorized get_entities: %.2fs" % new_time)
+    legacy_time, legacy_results = time_documents(legacy_get_entities, documents)
+    print("row by row get_entities: %.2fs" % legacy_time)
+
+    compact = CompactCorpus.from_frame(documents.df)
+    for doc_id, new, legacy in zip(documents, new_results, legacy_results):
+        assert list(new.items()) == list(legacy.items())
+        spans = get_span_entities(doc_id, *compact.get_mentions(doc_id))
+        assert list(spans.items()) == list(legacy.items()), doc_id
+    print("speedup: %.1fx" % (legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
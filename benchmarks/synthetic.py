@@ -0,0 +1,56 @@
+"""Synthetic CoNLL-2012 style corpora for benchmarks"""
+from __future__ import print_function
+import os
+import random
+
+WORDS = ['the', 'man', 'said', 'he', 'I', 'you', 'it', 'was', 'a', 'dog', 'Bush', 'they', 'me', 'house',
+         'president', 'his', 'she', 'her', 'company', 'year', 'in', 'of', 'to', 'and', 'that']
+POS_TAGS = ['DT', 'NN', 'VBD', 'PRP', 'NNP', 'PRP$', 'IN', 'CC', 'NNS', 'JJ']
+SPEAKERS = ['speaker1', 'speaker2', 'speaker3', '-']
+
+
+def write_corpus(root, n_docs=10000, parts_per_file=4, tokens_per_doc=200, seed=0):
+    """Write n_docs documents to root/<genre>/<source>/<nn>/*.v4_gold_conll files. Returns the file names."""
+    rnd = random.Random(seed)
+    data_files = []
+    n_files = (n_docs + parts_per_file - 1) // parts_per_file
+    for file_nb in range(n_files):
+        directory = os.path.join(root, 'bn', 'syn', '%02d' % (file_nb // 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        file_id = 'bn/syn/%02d/syn_%04d' % (file_nb // 100, file_nb)
+        data_file = os.path.join(directory, 'syn_%04d.v4_gold_conll' % file_nb)
+        with open(data_file, 'w') as f:
+            for part in range(min(parts_per_file, n_docs - file_nb * parts_per_file)):
+                f.write('#begin document (%s); part %03d\n' % (file_id, part))
+                write_document(f, rnd, file_id, part, tokens_per_doc)
+                f.write('#end document\n')
+        data_files.append(data_file)
+    return data_files
+
+
+def write_document(f, rnd, file_id, part, n_tokens):
+    n_written = 0
+    speaker = rnd.choice(SPEAKERS)
+    while n_written < n_tokens:
+        sentence_length = rnd.randint(5, 25)
+        if rnd.random() < 0.3:
+            speaker = rnd.choice(SPEAKERS)
+        open_ids = []
+        for word_nb in range(sentence_length):
+            tags = []
+            if rnd.random() < 0.15:
+                coref_id = rnd.randint(0, 20)
+                tags.append('(%d' % coref_id)
+                open_ids.append(coref_id)
+            while open_ids and (rnd.random() < 0.5 or word_nb == sentence_length - 1):
+                coref_id = open_ids.pop()
+                if tags and tags[-1] == '(%d' % coref_id:
+                    tags[-1] += ')'
+                else:
+                    tags.append('%d)' % coref_id)
+            coref = '|'.join(tags) if tags else '-'
+            f.write('%s  %d  %d  %s  %s  (NP*)  -  -  -  %s  *  (ARG0*)  *  %s\n' % (
+                file_id, part, word_nb, rnd.choice(WORDS), rnd.choice(POS_TAGS), speaker, coref))
+        f.write('\n')
+        n_written += sentence_length
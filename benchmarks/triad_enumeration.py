@@ -0,0 +1,52 @@
+"""Benchmark the windowed triad enumeration against filtering all combinations
+
+    $python -m benchmarks.triad_enumeration --n_mentions 500 --max_distance 15
+"""
+from __future__ import print_function
+import argparse
+import time
+from itertools import combinations
+
+import numpy as np
+
+from src.build_data import get_triad_indexes, NEIGHBORHOOD
+
+
+def legacy_triad_indexes(orders, max_distance):
+    """what generate_triad_input used to do: filter combinations(range(N), 3) by the triad distances"""
+    triads = []
+    for a, b, c in combinations(range(len(orders)), 3):
+        distances = [orders[a] - orders[b], orders[b] - orders[c], orders[a] - orders[c]]
+        diameter = max([abs(item) for item in distances])
+        neighborhood = min([abs(item) for item in distances])
+        if diameter <= max_distance and neighborhood <= NEIGHBORHOOD:
+            triads.append((a, b, c))
+    return triads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_mentions", default=500, type=int, help="mentions in the document")
+    parser.add_argument("--max_distance", default=15, type=int, help="maximum triad diameter")
+    args = parser.parse_args()
+
+    orders = np.arange(args.n_mentions)
+    orders = np.concatenate([orders[:1], orders])  # the first entity is repeated
+    orders_list = orders.tolist()
+
+    start = time.time()
+    triads = list(zip(*[indexes.tolist() for indexes in get_triad_indexes(orders, args.max_distance)]))
+    new_time = time.time() - start
+    print("windowed enumeration: %d triads in %.3fs" % (len(triads), new_time))
+
+    start = time.time()
+    legacy_triads = legacy_triad_indexes(orders_list, args.max_distance)
+    legacy_time = time.time() - start
+    print("filtered combinations: %d triads in %.3fs" % (len(legacy_triads), legacy_time))
+
+    assert triads == legacy_triads
+    print("speedup: %.1fx" % (legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
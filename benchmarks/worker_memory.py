@@ -0,0 +1,67 @@
+"""Benchmark the memory of triad generation workers reading a data frame, a compact corpus or a shared corpus
+
+    $python -m benchmarks.worker_memory --n_docs 2000 --threads 1 2 4
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from src.build_data import DataGen
+from src.compact_corpus import CompactCorpus
+from src.conll_reader import read_conll_files
+from src.shared_corpus import SharedCorpus
+from src.triad_loader import TriadLoader
+from benchmarks.synthetic import write_corpus, WORDS, POS_TAGS
+
+
+def measure(corpus, threads, epochs, file_batch=50):
+    """mean RSS and private memory in MB of the workers after generating epochs of the corpus"""
+    words = ['UKN', '_START_', '_END_'] + WORDS
+    gen = DataGen(corpus, dict((word, i + 1) for i, word in enumerate(words)), POS_TAGS + ['_START_POS_', '_END_POS_', 'UKN'])
+    with TriadLoader(gen, file_batch=file_batch, threads=threads, compact=True) as loader:
+        for _ in range(epochs * len(gen.documents.doc_ids) // file_batch):
+            next(loader)
+        return np.mean(loader.memory_usage()), np.mean(loader.memory_usage(private=True))
+
+
+def run(data_files, corpus_type, thread_counts, epochs):
+    """measure the workers of one kind of corpus, read in this process so it holds no other corpus"""
+    corpus = read_conll_files(data_files)
+    corpus.word_nb = pd.to_numeric(corpus.word_nb, errors='coerce')  # like build_dataFrame
+    if corpus_type == 'compact corpus':
+        corpus = CompactCorpus.from_frame(corpus)
+    elif corpus_type == 'shared corpus':
+        corpus = SharedCorpus(corpus)
+    for threads in thread_counts:
+        rss, private = measure(corpus, threads, epochs)
+        print("%s, %d workers: %.0f MB resident, %.1f MB private per worker" % (corpus_type, threads, rss, private))
+    if corpus_type == 'shared corpus':
+        corpus.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_docs", default=2000, type=int, help="number of synthetic documents")
+    parser.add_argument("--tokens_per_doc", default=200, type=int, help="tokens per document")
+    parser.add_argument("--threads", default=[1, 2, 4], type=int, nargs='+', help="worker counts")
+    parser.add_argument("--epochs", default=2, type=int, help="epochs to generate")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        data_files = write_corpus(root, n_docs=args.n_docs, tokens_per_doc=args.tokens_per_doc)
+        for corpus_type in ('data frame', 'compact corpus', 'shared corpus'):
+            process = multiprocessing.Process(target=run, args=(data_files, corpus_type, args.threads, args.epochs))
+            process.start()
+            process.join()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
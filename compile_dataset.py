@@ -0,0 +1,48 @@
+"""Compile the triads of a corpus into a triad dataset, with the vocabularies of a trained model"""
+import argparse
+import os
+
+from src.build_data import build_dataFrame, DataGen, MAX_DISTANCE
+from src.token_store import TokenStore
+from src.triad_dataset import compile_triad_dataset
+from src.vocabulary import load_vocabularies
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("corpus_dir",
+                        help="Directory containing annotations, or a token store")
+
+    parser.add_argument("model_dir",
+                        help="Directory of the model whose word and pos tag vocabularies encode the triads")
+
+    parser.add_argument("dataset_dir",
+                        help="Where to store the compiled dataset")
+
+    parser.add_argument("--max_distance",
+                        default=MAX_DISTANCE,
+                        type=int,
+                        help="Maximum distance between the mentions of a triad")
+
+    parser.add_argument("--threads",
+                        default=4,
+                        type=int,
+                        help="Number of processes")
+
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.corpus_dir)
+
+    if os.path.isfile(os.path.join(args.corpus_dir, 'meta.json')):
+        corpus = TokenStore(args.corpus_dir)
+    else:
+        corpus = build_dataFrame(args.corpus_dir, threads=args.threads, compact=True)
+    word_vocab, pos_vocab = load_vocabularies(args.model_dir)
+    gen = DataGen(corpus, word_indexes=word_vocab, pos_tags=pos_vocab)
+    compile_triad_dataset(gen, args.dataset_dir, max_distance=args.max_distance, threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Export a trained pytorch triad model with a trimmed word embedding table.
+
+Only the words seen in training and the top K GloVe words are kept, so the exported model
+loads faster and takes less memory.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from src.build_data import build_dataFrame
+from src.vocabulary import Vocabulary, load_vocabularies, save_vocabularies, trim_vocabulary
+from src.word2vec import load_glove_cache
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("model_dir",
+                        help="Directory containing the trained model")
+
+    parser.add_argument("export_dir",
+                        help="Where to store the exported model")
+
+    parser.add_argument("train_dir",
+                        help="Directory containing the training annotations. Words seen in training are kept")
+
+    parser.add_argument("--top_k",
+                        default=20000,
+                        type=int,
+                        help="Also keep the top K most frequent GloVe words")
+
+    parser.add_argument("--glove",
+                        default=os.environ['HOME'] + '/projects/embeddings/glove.840B.300d.txt',
+                        help="GloVe file the vocabulary was built from")
+
+    parser.add_argument("--float16",
+                        action='store_true',
+                        default=False,
+                        help="Store the word embedding table in half precision")
+
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.model_dir)
+    if not os.path.isdir(args.export_dir):
+        os.makedirs(args.export_dir)
+
+    import torch
+    from src.torch_models import get_word_embedding, set_word_embeddings
+
+    word_vocab, pos_vocab = load_vocabularies(args.model_dir)
+    assert isinstance(word_vocab, Vocabulary), "hashed word embeddings have a fixed size and are not trimmed"
+    corpus = build_dataFrame(args.train_dir, threads=4, compact=True)
+    glove_words, _, _ = load_glove_cache(args.glove)
+    keep_words = set(corpus.unique('word')) | set(glove_words[:args.top_k])
+
+    model = torch.load(os.path.join(args.model_dir, 'model.pt'))
+    embedding_matrix = get_word_embedding(model).weight.data.cpu().numpy()
+    assert len(embedding_matrix) == len(word_vocab) + word_vocab.first_code
+    trimmed_vocab, trimmed_matrix = trim_vocabulary(word_vocab, embedding_matrix, keep_words)
+    set_word_embeddings(model, trimmed_matrix, float16=args.float16)
+
+    torch.save(model, os.path.join(args.export_dir, 'model.pt'))
+    save_vocabularies(args.export_dir, trimmed_vocab, pos_vocab)
+    np.save(os.path.join(args.export_dir, 'embedding_matrix.npy'), trimmed_matrix)
+    print("word embedding table trimmed from %d to %d words, %.1f MB stored" % (
+        len(word_vocab), len(trimmed_vocab),
+        trimmed_matrix.size * (2 if args.float16 else 4) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Add new or changed annotation files to a token store, and extend the word vocabulary of a trained model"""
+import argparse
+import os
+
+import numpy as np
+
+from src.build_data import DataGen
+from src.token_store import ingest
+from src.vocabulary import Vocabulary, load_vocabularies, save_vocabularies
+from src.word2vec import get_glove
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("corpus_dir",
+                        help="Directory containing annotations")
+
+    parser.add_argument("token_store",
+                        help="Directory of the token store. It is created if it does not exist yet")
+
+    parser.add_argument("--model_dir",
+                        default=None,
+                        help="Directory of a trained model. Its word vocabulary and the word embedding table of "
+                             "model.pt are extended with the new words, existing indexes are kept. The pos tag layers "
+                             "of the model have a fixed size, new pos tags are encoded as UKN")
+
+    parser.add_argument("--glove",
+                        default=os.environ['HOME'] + '/projects/embeddings/glove.840B.300d.txt',
+                        help="Word vectors of the new words are read from this file")
+
+    parser.add_argument("--suffix",
+                        default='gold_conll',
+                        help="Suffix of the annotation files")
+
+    parser.add_argument("--threads",
+                        default=4,
+                        type=int,
+                        help="Number of parser processes")
+
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.corpus_dir)
+
+    store, added_docs = ingest(args.corpus_dir, args.token_store, suffix=args.suffix, threads=args.threads)
+    if args.model_dir is None or not added_docs:
+        return
+
+    word_vocab, pos_vocab = load_vocabularies(args.model_dir)
+    if not isinstance(word_vocab, Vocabulary):
+        print("hashed word embeddings represent any word, the model is kept")
+        return
+
+    import torch
+    from src.torch_models import get_word_embedding, set_word_embeddings
+
+    model_file = os.path.join(args.model_dir, 'model.pt')
+    model = torch.load(model_file)
+    weight = get_word_embedding(model).weight
+    gen = DataGen(store, word_indexes=word_vocab, pos_tags=pos_vocab)
+    gen.embedding_matrix = weight.data.float().cpu().numpy()
+    first_index = len(gen.embedding_matrix)
+
+    new_words = dict((word, '') for word in store.unique('word') if word not in word_vocab)
+    word_vectors = get_glove(new_words, args.glove) if new_words else {}
+    new_words, _ = gen.extend_vocabulary(word_vectors, pos_tags=[])
+    if not new_words:
+        return
+
+    # the model first, so the vocabulary never has words the model can not embed
+    set_word_embeddings(model, gen.embedding_matrix, float16=weight.dtype == torch.float16)
+    torch.save(model, model_file)
+    save_vocabularies(args.model_dir, gen.word_indexes, gen.pos_tags)
+    embedding_file = os.path.join(args.model_dir, 'embedding_matrix.npy')
+    if os.path.isfile(embedding_file):  # the initial table of training, extended with the same rows
+        np.save(embedding_file, np.concatenate([np.load(embedding_file), gen.embedding_matrix[first_index:]]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,12 @@
 import argparse
 import glob
 import os
-import pickle
 import shutil
 import subprocess
 
 from src.build_data import build_dataFrame, DataGen, group_data, slice_data
 from src.evaluator import Evaluator, TriadEvaluator
+from src.vocabulary import load_vocabularies
 
 
 def scorer(path=None):
@@ -83,10 +83,7 @@ def main():
     args = parser.parse_args()
 
 
-    with open(os.path.join(args.model_dir, 'word_indexes.pkl'), 'rb') as f:
-        word_indexes = pickle.load(f)
-    with open(os.path.join(args.model_dir, 'pos_tags.pkl'), 'rb') as f:
-        pos_tags = pickle.load(f)
+    word_indexes, pos_tags = load_vocabularies(args.model_dir)
 
     df = build_dataFrame(args.test_dir, threads=1, suffix='auto_conll')
     if args.clustering_only:
@@ -95,18 +92,18 @@ def main():
         from keras.models import load_model
         model = load_model(os.path.join(args.model_dir, 'model.h5'))
     else:
-        import torch
-        model = torch.load(os.path.join(args.model_dir, 'model.pt'))
+        from src.torch_models import load_torch_model
+        model = load_torch_model(os.path.join(args.model_dir, 'model.pt'))
         model.eval()
     print("Loaded model")
 
     if args.triad:
-        n_files = len(df.doc_id.unique())
         test_gen = DataGen(df, word_indexes, pos_tags)
-        test_input_gen = test_gen.generate_triad_input(looping=True, test_data=True, threads=4, max_distance=args.max_distance)
+        n_files = len(test_gen.documents)
+        test_input_gen = test_gen.generate_triad_eval(threads=4, max_distance=args.max_distance)
         evaluator = TriadEvaluator(model, test_input_gen)
 
-        evaluator.write_results(df, args.result_dir, n_iterations=n_files,
+        evaluator.write_results(test_gen.documents, args.result_dir, n_iterations=n_files,
                                 clustering_only=args.clustering_only, compute_linkage=args.compute_linkage)
 
     else:
@@ -118,7 +115,7 @@ def main():
         print("Performing fast evaluation...")
         print(evaluator.fast_eval())
         print("Saving result files...")
-        evaluator.write_results(df, args.result_dir)
+        evaluator.write_results(test_gen.documents, args.result_dir)
 
     scorer(args.result_dir)
 
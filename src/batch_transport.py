@@ -0,0 +1,157 @@
+"""Pass generated data from worker processes through shared memory slots instead of pickling the arrays"""
+from __future__ import print_function
+import io
+import mmap
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+SLOT_BYTES = 8 * 2 ** 20
+ALIGNMENT = 64
+
+
+class SlotFull(Exception):
+    pass
+
+
+class SlotPickler(pickle.Pickler):
+    """Pickles numpy arrays as references to copies in a shared memory slot"""
+    def __init__(self, f, buffer):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.buffer = buffer
+        self.offset = 0
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or obj.size == 0:
+            return None
+        start = (self.offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        if start + obj.nbytes > len(self.buffer):
+            raise SlotFull()
+        view = np.frombuffer(self.buffer, dtype=obj.dtype, count=obj.size, offset=start).reshape(obj.shape)
+        view[...] = obj
+        self.offset = start + obj.nbytes
+        return ('ndarray', start, obj.dtype.str, obj.shape)
+
+
+class SlotUnpickler(pickle.Unpickler):
+    """Unpickles the arrays of a SlotPickler as views of the shared memory slot, without copying"""
+    def __init__(self, f, buffer):
+        pickle.Unpickler.__init__(self, f)
+        self.buffer = buffer
+
+    def persistent_load(self, pid):
+        _, start, dtype, shape = pid
+        count = int(np.prod(shape))
+        return np.frombuffer(self.buffer, dtype=np.dtype(dtype), count=count, offset=start).reshape(shape)
+
+
+def iter_arrays(obj):
+    """numpy arrays of a datum: nested lists, tuples, dicts and objects such as TriadBatch"""
+    if isinstance(obj, np.ndarray):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            for array in iter_arrays(value):
+                yield array
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            for array in iter_arrays(value):
+                yield array
+    elif hasattr(obj, '__dict__'):
+        for array in iter_arrays(vars(obj)):
+            yield array
+
+
+def get_nbytes(datum):
+    """total bytes of the numpy arrays of a datum"""
+    return sum(array.nbytes for array in iter_arrays(datum))
+
+
+def spill(datum, directory=None):
+    """worker side: message for a datum whose arrays are written to a temporary file in directory"""
+    size = ALIGNMENT + sum(array.nbytes + ALIGNMENT for array in iter_arrays(datum))
+    fd, path = tempfile.mkstemp(suffix='.spill', dir=directory)
+    try:
+        os.ftruncate(fd, size)
+        buffer = mmap.mmap(fd, size)
+        f = io.BytesIO()
+        SlotPickler(f, buffer).dump(datum)
+        buffer.close()
+    finally:
+        os.close(fd)
+    return ('spilled', path, f.getvalue())
+
+
+def unpack(message):
+    """consumer side: datum of a 'pickled' or 'spilled' message. The arrays of a spilled datum are
+       private memory maps of its file, which is removed
+    """
+    if message[0] == 'pickled':
+        return message[1]
+    _, path, header = message
+    with open(path, 'r+b') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    os.remove(path)  # the data stays mapped
+    return SlotUnpickler(io.BytesIO(header), buffer).load()
+
+
+class SharedSlots(object):
+    """Preallocated shared memory slots, one datum per slot. Workers pack a datum into a free slot and
+       send the small message through their queue; the consumer unpacks numpy views of the slot.
+       It must be created before the workers are forked. When no slot is free, or a datum does not
+       fit, the datum is pickled whole as before.
+       Each worker packs into its own share of the slots, and whether a slot is used is a shared byte
+       written without a lock: the worker sets it, the consumer clears it when it releases the slot, or
+       reclaims the slots of a worker it replaced. So a killed worker never keeps a lock or a slot.
+    """
+    def __init__(self, n_slots, slot_bytes=SLOT_BYTES, n_workers=1):
+        assert n_slots >= n_workers
+        self.slot_bytes = slot_bytes
+        self.slots = [mmap.mmap(-1, slot_bytes) for _ in range(n_slots)]  # anonymous maps are shared with forked workers
+        self.used = multiprocessing.RawArray('b', n_slots)
+        self.shares = [list(range(worker, n_slots, n_workers)) for worker in range(n_workers)]
+        self.held = []
+
+    def pack(self, datum, worker=0):
+        """worker side: message to send instead of datum"""
+        free = [slot for slot in self.shares[worker] if not self.used[slot]]
+        if not free:
+            return ('pickled', datum)
+        slot = free[0]
+        f = io.BytesIO()
+        try:
+            SlotPickler(f, self.slots[slot]).dump(datum)
+        except SlotFull:
+            return ('pickled', datum)
+        self.used[slot] = 1
+        return ('slot', slot, f.getvalue())
+
+    def unpack(self, message):
+        """consumer side: datum of a message. Its arrays stay valid until release()"""
+        if message[0] != 'slot':
+            return unpack(message)
+        _, slot, header = message
+        self.held.append(slot)
+        return SlotUnpickler(io.BytesIO(header), self.slots[slot]).load()
+
+    def discard(self, message):
+        """consumer side: free the slot of a message that is not unpacked"""
+        if message is not None and message[0] == 'slot':
+            self.used[message[1]] = 0
+
+    def release(self):
+        """Recycle the slots of all unpacked data, whose arrays must not be used any more"""
+        for slot in self.held:
+            self.used[slot] = 0
+        self.held = []
+
+    def reclaim(self, worker):
+        """consumer side: free the slots of a worker that was replaced, except those of unpacked data.
+           Its messages that were not received are dropped with its queue
+        """
+        for slot in self.shares[worker]:
+            if slot not in self.held:
+                self.used[slot] = 0
@@ -1,23 +1,24 @@
 from __future__ import print_function
-import subprocess
 import os
-import sys
 import pandas as pd
-import re
 from collections import deque
 import numpy as np
-import time
-import multiprocessing
-from itertools import combinations
 
 from src.word2vec import build_vocab
 from src.preprocess import SPEAKER_MAP
+from src.corpus_cache import CorpusCache
+from src.conll_reader import find_conll_files, load_conll_files, get_frame
+from src.compact_corpus import CompactCorpus, extract_mentions
+from src.document_store import get_documents
+from src.vocabulary import Vocabulary, get_word_vocabulary, get_pos_vocabulary
 
 EMBEDDING_DIM = 300
 NEIGHBORHOOD = 3  # minimum distance between entities
 MAX_DISTANCE = 15  #40
 MAXLEN = 16  # max length of entities allowed
 BATCH_SIZE = 5
+CONTEXT_SIZE = 8  # tokens on each side of a mention
+SENTENCE_ENDS = ('.', '!', '?')
 
 def pad_sequences(sequences, maxlen=None, dtype='int32',
                   padding='pre', truncating='pre', value=0.):
@@ -77,63 +78,33 @@ def pad_sequences(sequences, maxlen=None, dtype='int32',
     return x
 
 
-def build_dataFrame(path, threads=4, suffix='gold_conll'):
-    def worker(pid):
-        print("worker %d started..." % pid)
-        df = None
-        counter = 0
-        while not file_queue.empty():
-            data_file = file_queue.get()
-            # sys.stdout.write("Worker %d: %d files remained to be processed\r" % (pid, file_queue.qsize()))
-            df = get_df(data_file, dataFrame=df)
-            counter += 1
-            if df is not None and counter % 10 == 0:
-                data_queue.put(df)
-                df = None
-        if df is not None:
-            data_queue.put(df)
-        print("\nWorker %d closed." % pid)
-
-    def worker_alive(workers):
-        worker_alive = False
-        for p in workers:
-            if p.is_alive(): worker_alive = True
-        return worker_alive
-
+def build_dataFrame(path, threads=4, suffix='gold_conll', use_cache=True, compact=False):
+    """Build a data frame from all *suffix files under path.
+       use_cache: load unchanged files from the on-disk corpus cache, and refresh it
+       compact: return an integer coded CompactCorpus instead of a data frame
+    """
     assert os.path.isdir(path)
-    cmd = 'find ' + path + ' -name "*%s"' % suffix
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True,stdin=subprocess.PIPE)
-    file_queue = multiprocessing.Queue()
-    data_queue = multiprocessing.Queue(maxsize=10)
-    for item in proc.stdout:
-        file_queue.put(item.strip())
-    n_files = file_queue.qsize()
+    data_files = find_conll_files(path, suffix)
+    n_files = len(data_files)
     print('%d conll files found in %s' % (n_files, path))
 
-    workers = [multiprocessing.Process(target=worker, args=(pid,)) for pid in range(threads)]
-
-    for p in workers:
-        p.daemon = True
-        p.start()
+    cache = CorpusCache(path, suffix, load=use_cache)
+    to_parse = cache.stale_files(data_files)
+    if use_cache:
+        print('%d files loaded from cache, %d files to parse' % (n_files - len(to_parse), len(to_parse)))
 
-    time.sleep(1)
-    df = None
+    parsed = {}
+    parsed_files = []
+    if to_parse:
+        parsed, parsed_files = load_conll_files(to_parse, threads=threads)
 
-    while df is None or len(df.file_id.unique()) < n_files:
-        item = data_queue.get()
-        if df is None:
-            df = item
-        else:
-            df = df.append(item)
-        sys.stdout.write("Processed %d files from data queue\r" % len(df.file_id.unique()))
-        # if not worker_alive(workers): break
+    arrays, files = cache.update(data_files, parsed, parsed_files, save=use_cache)
+    if compact:
+        corpus = CompactCorpus(arrays)
+        print("\ncompact corpus is built successfully! %d documents, %.1f MB of arrays" % (len(corpus), corpus.nbytes / 1e6))
+        return corpus
 
-    time.sleep(1)
-    assert data_queue.empty()
-    # Exit the completed processes
-    print("\nFinished assembling data frame.")
-    for p in workers:
-        p.join()
+    df = get_frame(arrays, files)
 
     # df.part_nb = pd.to_numeric(df.part_nb, errors='coerce')
     df.word_nb = pd.to_numeric(df.word_nb, errors='coerce')
@@ -143,42 +114,6 @@ def build_dataFrame(path, threads=4, suffix='gold_conll'):
     return df
 
 
-def get_df(data_file, dataFrame=None, n_fields=12):
-    data_list = []
-    with open(data_file) as f:
-        for line in f:
-            line = line.strip()
-            if line and line[0] != '#':
-                fields = line.split()
-                try:
-                    assert len(fields) >= n_fields
-                except AssertionError:
-                    print(fields)
-                    raise AssertionError
-                fields = fields[:11] + [fields[-1]]
-                data_list.append(fields)
-                # df.loc[len(df)] = fields
-
-    if not data_list:
-        return None
-
-    # 12 columns, ignore predicate arguments
-    columns = ['file_id', 'part_nb', 'word_nb', 'word', 'pos', 'parse', 'predicate_lemma',
-               'predicate_frame', 'word_sense', 'speaker', 'name_entities', 'coref']
-
-    new_data = pd.DataFrame(data_list, columns=columns)
-    unique_doc_ids = new_data["file_id"] + '-' + new_data["part_nb"].map(str)
-    new_data.insert(loc=0, column='doc_id', value=unique_doc_ids)
-    new_data = new_data.drop(['part_nb'], axis=1)
-
-    if dataFrame is None:
-        dataFrame = new_data
-
-    else:
-        dataFrame = dataFrame.append(new_data)
-
-    return dataFrame
-
 def replace_pronoun(df):
     first_persons = df.index[(df.word == 'I') | (df.word == 'me') | (df.word == 'myself')]
     second_persons = df.index[(df.word == 'you') | (df.word == 'You') | (df.word == 'yourself')]
@@ -218,125 +153,246 @@ def replace_pronoun(df):
     # print('\n', df.doc_id.values[0], count, ' pronouns replaced')
 
 def get_entities(df):
-    """returns {coref_id: {'start': [], 'end': [], 'stack': []}}"""
+    """returns {coref_id: {'start': [], 'end': [], 'stack': []}}
+       start and end are in the order the mentions are closed, stack holds mentions never closed
+    """
+    doc_codes, doc_ids = pd.factorize(df.doc_id.values)
+    doc_offsets = np.searchsorted(doc_codes, np.arange(len(doc_ids) + 1))
+    if np.any(np.diff(doc_codes) < 0):
+        raise ValueError("rows of a document are not contiguous")
+    starts, ends, clusters = extract_mentions(df.coref.values, doc_offsets)
+    docs = np.searchsorted(doc_offsets, starts, side='right') - 1
+    coref_ids = [doc_ids[doc] + '-' + str(cluster) for doc, cluster in zip(docs.tolist(), clusters.tolist())]
+
+    return group_mentions(coref_ids, starts, ends)
+
+
+def get_span_entities(doc_id, starts, ends, clusters):
+    """get_entities of the parsed mention spans of a document, e.g. CompactCorpus.get_mentions,
+       without rendering and parsing its coref column again. Spans are in the order they are opened
+    """
+    return group_mentions([doc_id + '-' + str(cluster) for cluster in clusters.tolist()], starts, ends)
+
+
+def group_mentions(coref_ids, starts, ends):
+    """{coref_id: {'start': [], 'end': [], 'stack': []}} of mentions in the order they are opened, see get_entities"""
     coref_entities = {}
-    prefix = re.compile('\(\d+')
-    suffix = re.compile('\d+\)')
-    n = len(df)
-    for i in range(n):
-        coref = df.iloc[i].coref
-        starts = prefix.findall(coref)
-        ends = suffix.findall(coref)
-
-        for item in starts:
-            coref_id = df.iloc[i].doc_id + '-' + item[1:]
-            if coref_id in coref_entities:
-                coref_entities[coref_id]['stack'].append(i)
-            else:
-                coref_entities[coref_id] = {'start': [], 'end': [], 'stack': [i]}
-
-        for item in ends:
-            coref_id = df.iloc[i].doc_id + '-' + item[:-1]
-            assert coref_id in coref_entities
-            coref_entities[coref_id]['end'].append(i)
-            try:
-                start = coref_entities[coref_id]['stack'].pop()
-            except IndexError:
-                print("IndexError", df.iloc[i-3:i+3])
-                sys.exit()
-            coref_entities[coref_id]['start'].append(start)
+    for coref_id in coref_ids:  # in the order the entities are first opened
+        if coref_id not in coref_entities:
+            coref_entities[coref_id] = {'start': [], 'end': [], 'stack': []}
+    # mentions closed in the same row are popped from the stack, most recently opened first
+    closing_order = np.lexsort((-np.arange(len(starts)), np.where(ends < 0, np.iinfo(np.int64).max, ends)))
+    starts = starts.tolist()
+    ends = ends.tolist()
+    for i in closing_order.tolist():
+        entity = coref_entities[coref_ids[i]]
+        if ends[i] < 0:
+            entity['stack'].append(starts[i])
+        else:
+            entity['start'].append(starts[i])
+            entity['end'].append(ends[i])
 
     return coref_entities
 
 
+def get_context_windows(doc_df, starts, ends, size=CONTEXT_SIZE, replace_space=True):
+    """Context words and pos tags of all mentions of a document, built in one pass.
+       The size tokens on each side of a mention are included. With replace_space, a '.' is inserted
+       before every sentence that does not follow a sentence end.
+       Returns (context_words, context_pos), one list per mention
+    """
+    words = doc_df.word.values
+    pos = doc_df.pos.values
+    n = len(words)
+    if replace_space:
+        sentence_start = (doc_df.word_nb.values == 0) & ~np.isin(words, SENTENCE_ENDS)
+    else:
+        sentence_start = np.zeros(n, dtype=bool)
+
+    # the document with the '.' tokens inserted. token_pos: position of each token in it,
+    # group_pos: position of each token including its '.', plus the length at the end
+    n_inserted = np.cumsum(sentence_start)
+    token_pos = np.arange(n) + n_inserted
+    group_pos = np.append(token_pos - sentence_start, n + (n_inserted[-1] if n else 0))
+    spaced_words = np.full(group_pos[-1], '.', dtype=object)
+    spaced_words[token_pos] = words
+    spaced_pos = np.full(group_pos[-1], '.', dtype=object)
+    spaced_pos[token_pos] = pos
+    spaced_words = spaced_words.tolist()
+    spaced_pos = spaced_pos.tolist()
+    words = words.tolist()
+    pos = pos.tolist()
+
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    # left context: tokens from left_edge to the mention, with the '.' after them
+    left_begins = token_pos[np.maximum(starts - size, 0)].tolist()
+    left_ends = token_pos[starts].tolist()
+    # right context: tokens after the mention up to right_edge, with the '.' before them
+    right_begins = group_pos[ends + 1].tolist()
+    right_ends = group_pos[np.minimum(ends + size + 1, n)].tolist()
+
+    context_words = []
+    context_pos = []
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        left = slice(left_begins[i], left_ends[i])
+        right = slice(right_begins[i], right_ends[i])
+        context_words.append(spaced_words[left] + ['_START_'] + words[start:end + 1] + ['_END_'] + spaced_words[right])
+        context_pos.append(spaced_pos[left] + ['_START_POS_'] + pos[start:end + 1] + ['_END_POS_'] + spaced_pos[right])
+    return context_words, context_pos
+
+
 class Entity(object):
-    def __init__(self, coref_id, df, start_loc, end_loc):
-        self.df = df
+    """A mention. Holds its tokens, not the document frame"""
+    __slots__ = ('coref_id', 'doc_id', 'start_loc', 'end_loc', 'speaker', 'order',
+                 'words', 'pos_tags', 'context_words', 'context_pos')
+
+    def __init__(self, coref_id, doc_id, start_loc, end_loc, speaker, words, pos_tags, context_words, context_pos):
+        self.coref_id = coref_id
+        self.doc_id = doc_id
         self.start_loc = start_loc
         self.end_loc = end_loc
-        self.coref_id = coref_id
-        self.speaker = df.iloc[start_loc].speaker
+        self.speaker = speaker
         self.order = None
-        self.replace_space = True
+        self.words = words
+        self.pos_tags = pos_tags
+        self.context_words = context_words
+        self.context_pos = context_pos
 
-        self.get_words()
-        self.get_pos_tags()
-        self.get_context_representation()
-        self.get_context_pos()
 
-    def get_words(self):
-        self.words = [self.df.iloc[i].word for i in range(self.start_loc, self.end_loc + 1)]
+def get_mention_order(starts):
+    """order of each mention in its document, e.g. 5 means it is the 5th mention. Mentions with the same start share an order"""
+    return np.searchsorted(np.sort(starts), starts)
+
+
+def expand_ranges(starts, ends):
+    """(row, value) arrays of all values of range(starts[i], ends[i]), row is i. Empty ranges are skipped"""
+    lengths = np.maximum(ends - starts, 0)
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    values = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return rows, values
+
+
+def get_triad_indexes(orders, max_distance, neighborhood=NEIGHBORHOOD, first=None):
+    """(a, b, c) index arrays of the triads a < b < c of mentions sorted by order, whose diameter is at most
+       max_distance and with two of the mentions at most neighborhood apart. Same triads, in the same order,
+       as filtering combinations(range(len(orders)), 3), but only the window of each mention is enumerated.
+       With neighborhood -1, the pairs b < c at most max_distance apart, with a = b
+       first: only the triads whose first mention is in this sorted array of indexes
+    """
+    orders = np.asarray(orders, dtype=np.int64)
+    window_ends = np.searchsorted(orders, orders + max_distance, side='right')  # mentions in range of each mention
+    first = np.arange(len(orders)) if first is None else np.asarray(first, dtype=np.int64)
+    if neighborhood == -1:
+        rows, c = expand_ranges(first + 1, window_ends[first])
+        return first[rows], first[rows], c
+    rows, b = expand_ranges(first + 1, window_ends[first])
+    a = first[rows]
+    pairs, c = expand_ranges(b + 1, window_ends[a])
+    a, b = a[pairs], b[pairs]
+    keep = np.minimum(orders[b] - orders[a], orders[c] - orders[b]) <= neighborhood
+    return a[keep], b[keep], c[keep]
+
+
+def count_triads(n_mentions, max_distance, neighborhood=NEIGHBORHOOD):
+    """number of triads of get_triad_indexes for n_mentions at consecutive orders, without enumerating them.
+       An estimate of the cost of a document
+    """
+    window = np.minimum(max_distance, n_mentions - 1 - np.arange(n_mentions))  # mentions after each one
+    if neighborhood == -1:
+        return int(window.sum())
+    far = np.maximum(window - 2 * neighborhood, 0)  # pairs with both gaps over neighborhood are excluded
+    return int((window * (window - 1) // 2 - far * (far - 1) // 2).sum())
 
-    def get_pos_tags(self):
-        self.pos_tags = [self.df.iloc[i].pos for i in range(self.start_loc, self.end_loc + 1)]
-
-    def get_order(self, coref_entities, locations=None):
-        """get the order of the entity in a doc  e.g. 5 means it is the 5th entity"""
-        if locations is not None:
-            self.order = locations.index(self.start_loc)
-            return self.order, locations
-
-        doc_id = self.df.iloc[self.start_loc].doc_id
-        # doc_entries = self.df.loc[self.df.doc_id == doc_id]
-        locations = []
-        for coref_id in coref_entities:
-            if doc_id in coref_id: # strings match
-                locations += coref_entities[coref_id]['start']
-        locations.sort()
-        self.order = locations.index(self.start_loc)
-        return self.order, locations
-
-    def get_context_representation(self):
-        left_edge = max(0, self.start_loc - 8)
-        # left_words = [self.df.iloc[i].word for i in range(left_edge, self.start_loc)]
-        left_words = []
-        for i in range(left_edge, self.start_loc):
-            left_words.append(self.df.iloc[i].word)
-            if self.replace_space \
-                    and self.df.iloc[i + 1].word_nb == 0 and self.df.iloc[i + 1].word not in ('.', '!', '?'):
-                left_words.append('.')
-
-        right_edge = min(len(self.df), self.end_loc + 9)
-        # right_words = [self.df.iloc[i].word for i in range(self.end_loc+1, right_edge)]
-        right_words = []
-        for i in range(self.end_loc+1, right_edge):
-            if self.replace_space \
-                    and self.df.iloc[i].word_nb == 0 and self.df.iloc[i].word not in ('.', '!', '?'):
-                right_words.append('.')
-            right_words.append(self.df.iloc[i].word)
-
-        self.context_words =  left_words + ['_START_'] + self.words + ['_END_'] + right_words
-
-    def get_context_pos(self):
-        left_edge = max(0, self.start_loc - 8)
-        # left_pos = [self.df.iloc[i].pos for i in range(left_edge, self.start_loc)]
-        left_pos = []
-        for i in range(left_edge, self.start_loc):
-            left_pos.append(self.df.iloc[i].pos)
-            if self.replace_space \
-                    and self.df.iloc[i + 1].word_nb == 0 and self.df.iloc[i + 1].word not in ('.', '!', '?'):
-                left_pos.append('.')
-
-        right_edge = min(len(self.df), self.end_loc + 9)
-        # right_pos = [self.df.iloc[i].pos for i in range(self.end_loc + 1, right_edge)]
-        right_pos = []
-        for i in range(self.end_loc+1, right_edge):
-            if self.replace_space \
-                    and self.df.iloc[i].word_nb == 0 and self.df.iloc[i].word not in ('.', '!', '?'):
-                right_pos.append('.')
-            right_pos.append(self.df.iloc[i].pos)
-
-        self.context_pos = left_pos + ['_START_POS_'] + self.pos_tags + ['_END_POS_'] + right_pos
+
+def get_triad_labels(mentions, triad_indexes):
+    """(n, 3) coreference labels of the mention pairs (a, b), (b, c), (c, a) of triads"""
+    a, b, c = triad_indexes
+    coref = mentions['coref']
+    return np.stack([coref[a] == coref[b], coref[b] == coref[c], coref[c] == coref[a]], axis=-1).astype(np.int64)
+
+
+def gather_triads(mentions, triad_indexes):
+    """Model inputs and labels of triads, gathered from the mention arrays of get_mention_arrays.
+       Returns (X, Y): X is 6 span distances and 3 speaker identities of shape (n, 1), then the words and
+       the pos tags of the 3 mentions of shape (n, MAXLEN). Y (n, 3) are the coreference labels
+    """
+    a, b, c = triad_indexes
+    start, end, speaker = mentions['start'], mentions['end'], mentions['speaker']
+    mention_spans = [start[a] - start[b], end[a] - end[b],
+                     start[b] - start[c], end[b] - end[c],
+                     start[a] - start[c], end[a] - end[c]]
+    speaker_identities = [speaker[a] == speaker[b], speaker[b] == speaker[c], speaker[c] == speaker[a]]
+    X = [np.expand_dims(x.astype(np.int64), axis=-1) for x in mention_spans + speaker_identities]
+    X += [mentions['words'][a], mentions['words'][b], mentions['words'][c],
+          mentions['pos'][a], mentions['pos'][b], mentions['pos'][c]]
+    return X, get_triad_labels(mentions, triad_indexes)
+
+
+class TriadBatch(object):
+    """Triads of a document as rows of mention indexes, instead of the 15 model input arrays.
+       The word and pos rows of a mention are stored once, not once per triad it is in.
+       mentions: mention arrays of DataGen.get_mention_arrays
+       triads: (n triads, 3) int32 mention indexes
+    """
+    def __init__(self, mentions, triads):
+        self.mentions = mentions
+        self.triads = triads
+
+    def __len__(self):
+        return len(self.triads)
+
+    def __getitem__(self, indexes):
+        """triads of a slice or index array, sharing the mention table"""
+        return TriadBatch(self.mentions, self.triads[indexes])
+
+    def expand(self):
+        """the 15 model input arrays"""
+        return gather_triads(self.mentions, self.triads.T)[0]
+
+
+def get_doc_entities(doc_df, coref_entities):
+    """Entities of a document, in the order of coref_entities (see get_entities), with their order set"""
+    coref_ids = []
+    starts = []
+    ends = []
+    for coref_id in coref_entities:
+        coref_ids += [coref_id] * len(coref_entities[coref_id]['start'])
+        starts += coref_entities[coref_id]['start']
+        ends += coref_entities[coref_id]['end']
+
+    context_words, context_pos = get_context_windows(doc_df, starts, ends)
+    doc_ids = doc_df.doc_id.values
+    speakers = doc_df.speaker.values
+    words = doc_df.word.values
+    pos = doc_df.pos.values
+    orders = get_mention_order(np.array(starts, dtype=np.int64)).tolist()
+    entities = []
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        entity = Entity(coref_ids[i], doc_ids[start], start, end, speakers[start], words[start:end + 1].tolist(),
+                        pos[start:end + 1].tolist(), context_words[i], context_pos[i])
+        entity.order = orders[i]
+        entities.append(entity)
+    return entities
 
 
 class DataGen(object):
-    def __init__(self, df, word_indexes={}, pos_tags=[]):
-        self.df = df
-        self.word_indexes = word_indexes
-        self.pos_tags = pos_tags
-        if not self.word_indexes:
+    def __init__(self, df, word_indexes=None, pos_tags=None):
+        """df: corpus data frame, DocumentStore or CompactCorpus
+           word_indexes, pos_tags: Vocabulary, or {word: index} dict and pos tag list, of a trained model.
+               With a HashedVocabulary, word inputs are (batch, MAXLEN, bag_size) buckets and there is no
+               embedding matrix
+        """
+        self.documents = get_documents(df)
+        self.df = self.documents.df
+        self.embedding_matrix = None
+        if word_indexes:
+            self.word_indexes = get_word_vocabulary(word_indexes)
+        else:
             self.get_embedding_matrix()
-        if not self.pos_tags:
+        if pos_tags:
+            self.pos_tags = get_pos_vocabulary(pos_tags)
+        else:
             self.get_pos_tags()
 
     def generate_input(self, negative_ratio=0.8, file_batch=100, looping=True, test_data=False, **kwargs):
@@ -350,7 +406,7 @@ class DataGen(object):
         else:
             max_distance = MAX_DISTANCE
 
-        doc_ids = self.df.doc_id.unique()
+        doc_ids = self.documents.doc_ids.copy()
         data_q = deque()
         if test_data:
             file_batch = 1 # yield data from one file only
@@ -360,21 +416,16 @@ class DataGen(object):
             for doc_id in doc_ids:
                 index_map = {}
                 # print("Generating data for %s" % doc_id)
-                doc_df = self.df.loc[self.df.doc_id == doc_id]
+                doc_df = self.documents.get(doc_id)
                 doc_coref_entities = get_entities(doc_df)
 
                 # get entity list
-                entities = []
-                locations = None
-                for coref_id in doc_coref_entities:
-                    for start_loc, end_loc in zip(doc_coref_entities[coref_id]['start'], doc_coref_entities[coref_id]['end']):
-                        entity = Entity(coref_id, doc_df, start_loc, end_loc)
-                        order, locations = entity.get_order(doc_coref_entities, locations=locations)
-                        entities.append((order, entity))
+                entities = get_doc_entities(doc_df, doc_coref_entities)
 
                 if not entities:
                     continue
-                entities = [e[1] for e in sorted(entities, key=lambda x: x[0])]  # sorted according to order
+                entities.sort(key=lambda entity: entity.order)
+                word_codes, pos_codes = self.encode_entities(entities, first_letter=False)
                 index = 0
 
                 # generate pairwise input. Process in narrative order
@@ -394,18 +445,10 @@ class DataGen(object):
                             same_speaker = 1
                         else:
                             same_speaker = 0
-                        words_i = entity.context_words
-                        # words_i = entity.words
-                        word_i_indexes = [self.word_indexes[word] if word in self.word_indexes else self.word_indexes['UKN'] for word in words_i]
-                        pos_i = entity.context_pos
-                        # pos_i = entity.pos_tags
-                        pos_i_indexes = [self.pos_tags.index(pos)+1 if pos in self.pos_tags else self.pos_tags.index('UKN') for pos in pos_i]
-                        words_j = entities[j].context_words
-                        # words_j = entities[j].words
-                        word_j_indexes = [self.word_indexes[word] if word in self.word_indexes else self.word_indexes['UKN'] for word in words_j]
-                        pos_j = entities[j].context_pos
-                        # pos_j = entities[j].pos_tags
-                        pos_j_indexes = [self.pos_tags.index(pos)+1 if pos in self.pos_tags else self.pos_tags.index('UKN') for pos in pos_j]
+                        word_i_indexes = word_codes[i]
+                        pos_i_indexes = pos_codes[i]
+                        word_j_indexes = word_codes[j]
+                        pos_j_indexes = pos_codes[j]
                         y = int(entity.coref_id == entities[j].coref_id)
 
                         X0.append([distance]) # use list to add a dimension
@@ -457,9 +500,14 @@ class DataGen(object):
                 break
 
 
-    def generate_triad_input(self, file_batch=100, looping=True, test_data=False, threads=4, **kwargs):
+    def generate_triad_input(self, file_batch=100, looping=True, test_data=False, threads=4, compact=False,
+                             shared_memory=False, **kwargs):
         """Generate triad input
            file_batch: # files to process and yield each time
+           compact: yield the triads of each file as a TriadBatch instead of the 15 input arrays
+           shared_memory: workers pass their arrays through shared memory slots. The arrays of a yielded
+               batch are views of the slots, they are only valid until the next batch is requested
+           The workers are stopped when the generator is closed, see TriadLoader
          """
         if 'max_distance' in kwargs:
             max_distance = kwargs['max_distance']
@@ -467,156 +515,57 @@ class DataGen(object):
             max_distance = MAX_DISTANCE
 
         print("max distance: %d" % max_distance)
-        def worker(doc_id_q, out_q):
-            while True:
-                doc_id = doc_id_q.get()
-                index_map = {}
-                # print("Generating data for %s" % doc_id)
-                doc_df = self.df.loc[self.df.doc_id == doc_id]
-                doc_df = doc_df.reset_index()
-                # replace_pronoun(doc_df)
-                doc_coref_entities = get_entities(doc_df)
-
-                # get entity list
-                entities = []
-                locations = None
-                for coref_id in doc_coref_entities:
-                    for start_loc, end_loc in zip(doc_coref_entities[coref_id]['start'],
-                                                  doc_coref_entities[coref_id]['end']):
-                        entity = Entity(coref_id, doc_df, start_loc, end_loc)
-                        order, locations = entity.get_order(doc_coref_entities, locations=locations)
-                        entities.append((order, entity))
-
-                # for e in entities:
-                #     print(e[1].start_loc, e[1].end_loc)
-
-                if not entities:
-                    if test_data:
-                        print("No entities found in file:", doc_id)
-                        out_q.put([])
-                    continue
-                entities = [e[1] for e in sorted(entities, key=lambda x: x[0])]  # sorted according to order
-                N = len(entities)
-                if N < 2:
-                    print("Only one entity in %s" % doc_id)
-                    continue
-                # elif N < 3:
-                #     # entities.append(entities[0])  # expand a dyad to a triad
-                #     N += 1
-
-                if NEIGHBORHOOD != -1:
-                    entities.insert(0, entities[0])  # always repeat the first entity
-                    triad_indexes = combinations(range(N+1), 3)
-                else:
-                    triad_indexes = combinations(range(N), 2)
-                    # triad_indexes = [(item[0], item[0], item[1]) for item in combinations(range(N), 2)]
-
-                X = [[] for _ in range(15)]
-                Y = []
-                index = 0
-                for numbers in triad_indexes:
-                    if NEIGHBORHOOD != -1:
-                        a, b, c = numbers
-                        if a == b == 0 and c > 1 : continue
-                    else:
-                        b, c = numbers
-                        a = b
-                    # assert a <= b <= c
-                    try:
-                        triad = (entities[a], entities[b], entities[c])
-                    except IndexError:
-                        print(N, a, b, c)
-                        raise IndexError
-
-
-                    # print(triad[2].start_loc, triad[2].end_loc)
-                    # if triad[1].start_loc < triad[0].start_loc or triad[2].start_loc < triad[1].start_loc:
-                    #     print(doc_id, (triad[0].start_loc, triad[0].end_loc),
-                    #                    (triad[1].start_loc, triad[1].end_loc),
-                    #                    (triad[2].start_loc, triad[2].end_loc))
-                    #     sys.exit()
-                    distances = DataGen.get_triad_distances(triad)
-                    diameter = max([abs(item) for item in distances])  # maximum distance between entities
-                    neighborhood = min([abs(item) for item in distances])  # minimum distance between entities
-                    if diameter <= max_distance and (neighborhood <= NEIGHBORHOOD or NEIGHBORHOOD == -1):
-
-                        mention_spans = [triad[0].start_loc - triad[1].start_loc, triad[0].end_loc - triad[1].end_loc,
-                                         triad[1].start_loc - triad[2].start_loc, triad[1].end_loc - triad[2].end_loc,
-                                         triad[0].start_loc - triad[2].start_loc, triad[0].end_loc - triad[2].end_loc]
-
-                        speaker_identities = [int(triad[0].speaker == triad[1].speaker),
-                                              int(triad[1].speaker == triad[2].speaker),
-                                              int(triad[2].speaker == triad[0].speaker)]
-
-                        word_indexes = [self.get_word_indexes(triad[0].context_words),
-                                        self.get_word_indexes(triad[1].context_words),
-                                        self.get_word_indexes(triad[2].context_words)]
-
-                        pos_indexes = [self.get_pos_indexes(triad[0].context_pos),
-                                       self.get_pos_indexes(triad[1].context_pos),
-                                       self.get_pos_indexes(triad[2].context_pos)]
-
-                        # X_triad = distances + speaker_identities + word_indexes + pos_indexes
-                        X_triad = mention_spans + speaker_identities + word_indexes + pos_indexes
-
-                        for i in range(len(X_triad)):
-                            X[i].append(X_triad[i])
-                        y_triad = [int(triad[0].coref_id == triad[1].coref_id),
-                                   int(triad[1].coref_id == triad[2].coref_id),
-                                   int(triad[2].coref_id == triad[0].coref_id)]
-                        Y.append(np.array(y_triad))
-
-                        if test_data:
-                            index_map[(doc_id,
-                                       (triad[0].start_loc, triad[0].end_loc),
-                                       (triad[1].start_loc, triad[1].end_loc),
-                                       (triad[2].start_loc, triad[2].end_loc))] = index
-                            index += 1
-
-                for i in range(9):  # distance and speaker
-                    X[i] = np.array(X[i])
-                    X[i] = np.expand_dims(X[i], axis=-1)
-
-                for i in range(9, 15):  # word and pos tag indexes
-                    X[i] = pad_sequences(X[i], maxlen=MAXLEN, dtype='int32', padding='pre', truncating='post',
-                                         value=0)
-                Y = np.array(Y)
-
-                if test_data:
-                    datum = [X, Y, index_map]
-                else:
-                    datum = [X, Y]
+        from src.triad_loader import TriadLoader  # triad_loader imports this module
+        with TriadLoader(self, file_batch=file_batch, looping=looping, test_data=test_data, threads=threads,
+                         compact=compact, shared_memory=shared_memory, max_distance=max_distance) as loader:
+            for data_q in loader:
+                yield data_q
 
-                out_q.put(datum)
+    def generate_triad_eval(self, threads=4, compact=False, **kwargs):
+        """Evaluation stream of triad input. Every document is processed exactly once, and the stream ends
+           when all documents are done. Yields (doc_id, [X, Y, index_map]) in the order the documents are
+           finished, or (doc_id, []) for documents with less than 2 entities.
+           Crashed workers are restarted, and an exception while processing a document is raised here,
+           see TriadLoader
+        """
+        max_distance = kwargs.get('max_distance', MAX_DISTANCE)
+        print("max distance: %d" % max_distance)
+        from src.triad_loader import TriadLoader  # triad_loader imports this module
+        with TriadLoader(self, looping=False, test_data=True, threads=threads, compact=compact,
+                         max_distance=max_distance) as loader:
+            for doc_id, datum in loader.documents():
+                yield doc_id, datum or []
+
+    def get_triad_datum(self, doc_id, max_distance=MAX_DISTANCE, test_data=False, compact=False, chunk=None):
+        """[X, Y] triad input of a document, plus the index_map of the triads for test data.
+           Returns [] for test data without entities, None if the document is skipped
+           chunk: (i, n), only the triads whose first mention is in the i-th of n ranges of mentions
+        """
+        entities = self.get_sorted_entities(doc_id)
+        if not entities:
+            if test_data:
+                print("No entities found in file:", doc_id)
+                return []
+            return None
+        if len(entities) < 2:
+            print("Only one entity in %s" % doc_id)
+            return None
+
+        mentions, triad_indexes = self.get_triad_arrays(entities, max_distance, chunk)
+        if chunk is not None and not len(triad_indexes[0]):
+            return None
+        if compact:
+            X = TriadBatch(mentions, np.stack(triad_indexes, axis=-1).astype(np.int32))
+            Y = get_triad_labels(mentions, triad_indexes)
+        else:
+            X, Y = gather_triads(mentions, triad_indexes)
 
-        # main process
-        doc_ids = self.df.doc_id.unique()
-        data_q = deque()
         if test_data:
-            file_batch = 1  # yield data from one file each time
-        out_q = multiprocessing.Queue(maxsize=200)
-        doc_id_q = multiprocessing.Queue()
-        workers = [multiprocessing.Process(target=worker, args=(doc_id_q, out_q)) for _ in range (threads)]
-        for worker in workers:
-            worker.daemon = True
-            worker.start()
-
-        while True:
-            if not test_data:
-                np.random.shuffle(doc_ids)
-            if doc_id_q.empty():
-                for doc_id in doc_ids:
-                    doc_id_q.put(doc_id)
-
-            datum = out_q.get()
-            data_q.append(datum)
-            if looping and len(data_q) == file_batch:
-                yield data_q
-                data_q = deque()
-
-            if not looping and len(data_q) == len(doc_ids):  # yield the whole data set, and break
-                yield data_q
-                break
+            spans = list(zip(mentions['start'].tolist(), mentions['end'].tolist()))
+            index_map = dict(((doc_id, spans[a], spans[b], spans[c]), index) for index, (a, b, c)
+                             in enumerate(zip(*[indexes.tolist() for indexes in triad_indexes])))
+            return [X, Y, index_map]
+        return [X, Y]
 
     @staticmethod
     def get_triad_distances(triad):
@@ -627,43 +576,109 @@ class DataGen(object):
         return [d0, d1, d2]
 
     def get_word_indexes(self, word_list):
-        # return [self.word_indexes[word] if word in self.word_indexes else self.word_indexes['UKN'] for word in word_list]
-        try:
-            return [self.word_indexes[word] if word in self.word_indexes else self.word_indexes.get(word[0],
-                                            self.word_indexes['UKN']) for word in word_list]  # use the first letter
-        except IndexError:
-            print(word_list)
-            raise IndexError
+        return self.word_indexes.encode(word_list)  # unknown words use the first letter, then UKN
 
     def get_pos_indexes(self, pos_list):
-        return [self.pos_tags.index(pos) + 1 if pos in self.pos_tags else self.pos_tags.index('UKN') for pos in pos_list]
+        return self.pos_tags.encode(pos_list)
+
+    def encode_entities(self, entities, first_letter=True):
+        """Encode the context words and pos tags of all entities of a document at once.
+           Returns ([word codes], [pos codes]), one array per entity
+        """
+        word_codes = self.word_indexes.encode_lists([entity.context_words for entity in entities], first_letter)
+        pos_codes = self.pos_tags.encode_lists([entity.context_pos for entity in entities])
+        return word_codes, pos_codes
+
+    def get_sorted_entities(self, doc_id):
+        """entities of a document sorted by order"""
+        if hasattr(self.documents, 'get_mentions'):  # mention spans parsed once, the coref column is not needed
+            doc_df = self.documents.get(doc_id, coref=False)
+            coref_entities = get_span_entities(doc_id, *self.documents.get_mentions(doc_id))
+        else:
+            doc_df = self.documents.get(doc_id).reset_index()
+            coref_entities = get_entities(doc_df)
+        # replace_pronoun(doc_df)
+        entities = get_doc_entities(doc_df, coref_entities)
+        entities.sort(key=lambda entity: entity.order)
+        return entities
+
+    def get_triad_arrays(self, entities, max_distance=MAX_DISTANCE, chunk=None):
+        """(mention arrays, triad indexes) of the entities of a document sorted by order.
+           The first entity is repeated, so the mention arrays have one more row than entities
+           chunk: (i, n), the triads whose first mention is in the i-th of n ranges of mentions. Only the
+               mentions within their reach are encoded, and the indexes are relative to the first of them
+        """
+        if NEIGHBORHOOD != -1:
+            entities = [entities[0]] + entities  # always repeat the first entity
+        orders = np.array([entity.order for entity in entities], dtype=np.int64)
+        if chunk is None:
+            return self.get_mention_arrays(entities), get_triad_indexes(orders, max_distance)
+        i, n_chunks = chunk
+        start, end = len(entities) * i // n_chunks, len(entities) * (i + 1) // n_chunks
+        reach = np.searchsorted(orders, orders[end - 1] + max_distance, side='right') if end > start else start
+        triad_indexes = get_triad_indexes(orders[start:reach], max_distance, first=np.arange(end - start))
+        return self.get_mention_arrays(entities[start:reach]), triad_indexes
+
+    def get_mention_arrays(self, entities):
+        """Features of each entity of a document, computed once: start, end, speaker and coref codes,
+           and the context words and pos tags encoded and padded to (n entities, MAXLEN)
+        """
+        word_codes, pos_codes = self.encode_entities(entities)
+        return {'start': np.array([entity.start_loc for entity in entities], dtype=np.int64),
+                'end': np.array([entity.end_loc for entity in entities], dtype=np.int64),
+                'speaker': pd.factorize(pd.Series([entity.speaker for entity in entities], dtype=object))[0],
+                'coref': pd.factorize(pd.Series([entity.coref_id for entity in entities], dtype=object))[0],
+                'words': pad_sequences(word_codes, maxlen=MAXLEN, dtype='int32', padding='pre', truncating='post', value=0),
+                'pos': pad_sequences(pos_codes, maxlen=MAXLEN, dtype='int32', padding='pre', truncating='post', value=0)}
 
     def get_embedding_matrix(self, word_vectors=None):
         if word_vectors is None:
             print('Loading word embeddings...')
             glove_path = os.environ['HOME'] + '/projects/embeddings/glove.840B.300d.txt'
-            word_vectors = build_vocab(self.df.word.unique(), glove_path, K=200000)
-            word_vectors['_START_'] = np.ones(EMBEDDING_DIM)
-            word_vectors['_END_'] = - np.ones(EMBEDDING_DIM)
-            word_vectors['UKN'] = np.random.uniform(-0.5, 0.5, EMBEDDING_DIM)
-
-        word_indexes = {}
-        embedding_matrix = np.random.uniform(low=-0.5, high=0.5, size=(len(word_vectors) + 1, EMBEDDING_DIM))
-        for index, word in enumerate(sorted(word_vectors.keys())):
-            word_indexes[word] = index + 1
-            embedding_vector = word_vectors.get(word, None)
-            embedding_matrix[index + 1] = embedding_vector
-        embedding_matrix[0] = np.zeros(EMBEDDING_DIM)  # used for mask/padding
+            word_vectors = build_vocab(self.documents.unique('word'), glove_path, K=200000)
+            word_vectors['_START_'] = np.ones(EMBEDDING_DIM, dtype=np.float32)
+            word_vectors['_END_'] = - np.ones(EMBEDDING_DIM, dtype=np.float32)
+            word_vectors['UKN'] = np.random.uniform(-0.5, 0.5, EMBEDDING_DIM).astype(np.float32)
+
+        words = sorted(word_vectors.keys())
+        embedding_matrix = np.zeros((len(words) + 1, EMBEDDING_DIM), dtype=np.float32)  # row 0 is used for mask/padding
+        embedding_matrix[1:] = np.stack([np.asarray(word_vectors[word], dtype=np.float32) for word in words])
 
         self.embedding_matrix = embedding_matrix
-        self.word_indexes = word_indexes
+        # unknown words use their first letter, then UKN
+        self.word_indexes = Vocabulary(words, words.index('UKN') + 1, first_code=1, first_letter=True)
 
     def get_pos_tags(self):
-        all_pos_tags = self.df.pos.unique()
+        all_pos_tags = np.array(self.documents.unique('pos'))
         all_pos_tags.sort()
         print("%d pos tags found" % len(all_pos_tags))
         print(all_pos_tags)
-        self.pos_tags = np.append(all_pos_tags, ['_START_POS_', '_END_POS_', 'UKN']).tolist()
+        self.pos_tags = Vocabulary.from_pos_tags(np.append(all_pos_tags, ['_START_POS_', '_END_POS_', 'UKN']).tolist())
+
+    def extend_vocabulary(self, word_vectors, pos_tags=None):
+        """Add new words and pos tags after the existing ones, so the indexes of a trained model stay valid.
+           word_vectors: {word: vector} of the new words. Words without a vector keep falling back to UKN
+           pos_tags: pos tags of the new documents, defaults to all tags of the corpus
+        """
+        first_index = len(self.word_indexes) + self.word_indexes.first_code
+        new_words = self.word_indexes.add(sorted(word_vectors))
+        if new_words and getattr(self, 'embedding_matrix', None) is not None:
+            assert len(self.embedding_matrix) == first_index
+            new_rows = np.array([word_vectors[word] for word in new_words], dtype=self.embedding_matrix.dtype)
+            self.embedding_matrix = np.concatenate([self.embedding_matrix, new_rows])
+
+        if pos_tags is None:
+            pos_tags = self.documents.unique('pos')
+        new_tags = self.pos_tags.add(sorted(set(pos_tags)))
+        print("vocabulary extended by %d words and %d pos tags" % (len(new_words), len(new_tags)))
+        return new_words, new_tags
+
+def take(X, indexes):
+    """instances of a TriadBatch or list of input arrays"""
+    if isinstance(X, TriadBatch):
+        return X[indexes]
+    return [x[indexes] for x in X]
+
 
 def slice_data(data, group_size):
     """Slice data to equal size
@@ -681,7 +696,7 @@ def slice_data(data, group_size):
 
         if n_chunks > 0:
             for m in range(n_chunks):
-                X_out = [x[m*group_size: (m+1)*group_size] for x in X]
+                X_out = take(X, slice(m*group_size, (m+1)*group_size))
                 y_out = y[m*group_size: (m+1)*group_size]
                 yield X_out, y_out
 
@@ -690,7 +705,7 @@ def slice_data(data, group_size):
             to_add = group_size - leftover
             indexes_to_add = np.random.choice(n, to_add)  # randomly sample more instances
             indexes = np.concatenate((np.arange(n_chunks * group_size, n), indexes_to_add))
-            X_out = [x[indexes] for x in X]
+            X_out = take(X, indexes)
             y_out = y[indexes]
             yield X_out, y_out
 
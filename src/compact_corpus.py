@@ -0,0 +1,166 @@
+"""Memory-compact, integer coded corpus.
+
+Instead of a data frame of Python strings, the corpus is kept as int32 code columns plus
+one vocabulary per column. Document ids are interned into row ranges, and the coref column
+is parsed once into mention span arrays. Columns the triad pipeline never reads (parse,
+predicate and word sense columns) are dropped. Integer arrays are not touched by reference
+counting, so forked generation workers share them instead of copying pages.
+
+The corpus is coded from the string columns read from the conll files, so only the memory it
+retains drops; the peak while loading is that of the string columns.
+"""
+from __future__ import print_function
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+CODED_COLUMNS = ('word', 'pos', 'speaker', 'name_entities')
+FRAME_COLUMNS = ['doc_id', 'file_id', 'word_nb', 'word', 'pos', 'speaker', 'name_entities', 'coref']
+
+
+def extract_mentions(coref, doc_offsets=None):
+    """Match the brackets of a coref column. Only the cells that are not '-' are parsed, in one stack pass.
+       doc_offsets: row offsets of the documents (n_docs + 1), brackets are matched within a document
+       Returns (starts, ends, clusters) arrays in the order the mentions are opened, i.e. by start row,
+       then by bracket order within the cell. Mentions that are never closed have end -1.
+    """
+    coref = np.asarray(coref, dtype=object)
+    rows = np.flatnonzero(coref != '-')
+    if doc_offsets is None:
+        docs = np.zeros(len(rows), dtype=np.int64)
+    else:
+        docs = np.searchsorted(doc_offsets, rows, side='right') - 1
+    stacks = defaultdict(list)  # (doc, cluster) -> open mentions
+    starts = []
+    ends = []
+    clusters = []
+    for row, doc, cell in zip(rows.tolist(), docs.tolist(), coref[rows]):
+        items = cell.split('|')
+        for item in items:  # all starts first, like get_entities used to
+            if item[0] == '(':
+                cluster = int(item[1:].rstrip(')'))
+                stacks[doc, cluster].append(len(starts))
+                starts.append(row)
+                ends.append(-1)
+                clusters.append(cluster)
+        for item in items:
+            if item[-1] == ')':
+                stack = stacks[doc, int(item[:-1].lstrip('('))]
+                if not stack:
+                    raise ValueError("coref %s in row %d closes a mention that is not open" % (cell, row))
+                ends[stack.pop()] = row
+
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), np.array(clusters, dtype=np.int32)
+
+
+def parse_coref_spans(coref, doc_offsets):
+    """Parse a coref column into mentions.
+       Returns (starts, ends, clusters) arrays of the closed mentions in the order they are opened, so sorted by
+       start row. The opening order of mentions starting on the same row decides the order of their entities.
+       Rows are global, a cluster is only unique within its document.
+    """
+    starts, ends, clusters = extract_mentions(coref, doc_offsets)
+    closed = ends >= 0
+    return starts[closed], ends[closed], clusters[closed]
+
+
+def render_coref(length, starts, ends, clusters):
+    """coref column of a document from its mentions (rows relative to the document start)"""
+    cells = [[] for _ in range(length)]
+    for start, end, cluster in zip(starts, ends, clusters):
+        if start == end:
+            cells[start].append('(%d)' % cluster)
+        else:
+            cells[start].append('(%d' % cluster)
+            cells[end].append('%d)' % cluster)
+    return ['|'.join(cell) if cell else '-' for cell in cells]
+
+
+class CompactCorpus(object):
+    """Integer coded corpus with the same document interface as DocumentStore"""
+    def __init__(self, arrays):
+        """arrays: {column: array} of the corpus, e.g. from the conll reader or the corpus cache"""
+        doc_codes, doc_ids = pd.factorize(arrays['doc_id'])
+        order = None
+        if len(doc_codes) and np.count_nonzero(np.diff(doc_codes)) + 1 != len(doc_ids):
+            order = np.argsort(doc_codes, kind='mergesort')  # group scattered documents
+            doc_codes = doc_codes[order]
+
+        def column(name):
+            values = np.asarray(arrays[name])
+            return values if order is None else values[order]
+
+        self.df = None
+        self.doc_ids = np.asarray(doc_ids, dtype=object)
+        offsets = np.searchsorted(doc_codes, np.arange(len(doc_ids) + 1))
+        self.doc_ranges = np.stack([offsets[:-1], offsets[1:]], axis=-1)  # (n_docs, 2) start and end rows
+        self.doc_index = dict((doc_id, i) for i, doc_id in enumerate(self.doc_ids))
+
+        word_nb = pd.to_numeric(column('word_nb'), errors='coerce').astype(np.float64)
+        self.word_nb = np.where(np.isnan(word_nb), -1, word_nb).astype(np.int32)
+        self.codes = {}
+        self.vocabs = {}
+        for name in CODED_COLUMNS:
+            codes, vocab = pd.factorize(column(name))
+            self.codes[name] = codes.astype(np.int32)
+            self.vocabs[name] = np.asarray(vocab, dtype=object)
+
+        self.mention_starts, self.mention_ends, self.mention_clusters = parse_coref_spans(column('coref'), offsets)
+        mention_offsets = np.searchsorted(self.mention_starts, offsets)
+        self.mention_ranges = np.stack([mention_offsets[:-1], mention_offsets[1:]], axis=-1)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(dict((name, df[name].values) for name in ['doc_id', 'word_nb', 'coref'] + list(CODED_COLUMNS)))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_index
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    @property
+    def nbytes(self):
+        arrays = [self.word_nb, self.doc_ranges, self.mention_starts, self.mention_ends,
+                  self.mention_clusters, self.mention_ranges] + list(self.codes.values())
+        return sum(array.nbytes for array in arrays)
+
+    def unique(self, column):
+        """distinct values of a coded column"""
+        return self.vocabs[column]
+
+    def get_range(self, doc_id):
+        """(start_row, end_row) of a document"""
+        start, end = self.doc_ranges[self.doc_index[doc_id]]
+        return int(start), int(end)
+
+    def mention_counts(self):
+        """number of mentions of each document"""
+        return self.mention_ranges[:, 1] - self.mention_ranges[:, 0]
+
+    def get_mentions(self, doc_id):
+        """(starts, ends, clusters) of a document, rows relative to the document start"""
+        i = self.doc_index[doc_id]
+        begin, end = self.mention_ranges[i]
+        start_row = self.doc_ranges[i, 0]
+        return (self.mention_starts[begin:end] - start_row, self.mention_ends[begin:end] - start_row,
+                self.mention_clusters[begin:end])
+
+    def get(self, doc_id, coref=True):
+        """Decoded data frame of a document, with the columns the pipeline reads.
+           coref: render the coref column from the mention spans, see get_mentions
+        """
+        start, end = self.get_range(doc_id)
+        data = {'doc_id': [doc_id] * (end - start),
+                'file_id': [doc_id.rsplit('-', 1)[0]] * (end - start),
+                'word_nb': self.word_nb[start:end]}
+        if coref:
+            data['coref'] = render_coref(end - start, *self.get_mentions(doc_id))
+        for name in CODED_COLUMNS:
+            data[name] = self.vocabs[name][self.codes[name][start:end]]
+        return pd.DataFrame(data, columns=[column for column in FRAME_COLUMNS if column in data])
+
+    __getitem__ = get
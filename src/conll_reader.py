@@ -0,0 +1,165 @@
+"""Streaming CoNLL reader.
+
+Token lines are split at the bytes level from a memory-mapped file and written straight
+into growable column arrays. Strings are decoded once per distinct value, when the
+columns are finalized.
+"""
+from __future__ import print_function
+import mmap
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+N_FIELDS = 12
+# 12 columns, ignore predicate arguments
+FIELDS = ['file_id', 'part_nb', 'word_nb', 'word', 'pos', 'parse', 'predicate_lemma',
+          'predicate_frame', 'word_sense', 'speaker', 'name_entities', 'coref']
+COLUMNS = ['doc_id', 'file_id', 'word_nb', 'word', 'pos', 'parse', 'predicate_lemma',
+           'predicate_frame', 'word_sense', 'speaker', 'name_entities', 'coref']
+
+
+def iter_conll_fields(data_file):
+    """yield the 12 fields (as bytes) of every token line in a conll file"""
+    with open(data_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(mm.readline, b''):
+                fields = line.split()
+                if fields and fields[0][:1] != b'#':
+                    if len(fields) < N_FIELDS:
+                        raise ValueError('%s: expected at least %d fields, found %s' % (data_file, N_FIELDS, fields))
+                    if len(fields) > N_FIELDS:
+                        fields[N_FIELDS - 1:] = fields[-1:]
+                    yield fields
+        finally:
+            mm.close()
+
+
+class ConllColumns(object):
+    """Preallocated, growable (rows, fields) table filled from conll files, one token line per row"""
+    def __init__(self, capacity=1 << 16):
+        self.size = 0
+        self.table = np.empty((capacity, N_FIELDS), dtype=object)
+        self.files = []  # (data_file, start_row, end_row)
+
+    def reserve(self, n):
+        capacity = len(self.table)
+        if self.size + n <= capacity:
+            return
+        grown = np.empty((max(self.size + n, 2 * capacity), N_FIELDS), dtype=object)
+        grown[:self.size] = self.table[:self.size]
+        self.table = grown
+
+    def add_file(self, data_file):
+        start = self.size
+        for fields in iter_conll_fields(data_file):
+            if self.size == len(self.table):
+                self.reserve(1)
+            self.table[self.size] = fields
+            self.size += 1
+        self.files.append((data_file, start, self.size))
+
+    def get_arrays(self):
+        """Decode the columns. Returns {column: object array}, with part_nb merged into doc_id"""
+        codes = {}
+        uniques = {}
+        for i, name in enumerate(FIELDS):
+            codes[name], raw_uniques = pd.factorize(self.table[:self.size, i])
+            uniques[name] = np.array([item.decode('utf-8') for item in raw_uniques], dtype=object)
+
+        n_parts = max(len(uniques['part_nb']), 1)
+        doc_codes, doc_inverse = np.unique(codes['file_id'].astype(np.int64) * n_parts + codes['part_nb'],
+                                           return_inverse=True)
+        doc_ids = np.array([uniques['file_id'][code // n_parts] + '-' + uniques['part_nb'][code % n_parts]
+                            for code in doc_codes], dtype=object)
+
+        arrays = {'doc_id': doc_ids[doc_inverse.reshape(-1)]}
+        for name in COLUMNS[1:]:
+            arrays[name] = uniques[name][codes[name]]
+        return arrays
+
+
+def get_frame(arrays, files):
+    """Data frame of parsed column arrays. Rows are indexed by their position within each file"""
+    lengths = np.array([end - start for _, start, end in files], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    df = pd.DataFrame(arrays, columns=COLUMNS)
+    df.index = np.arange(len(df)) - np.repeat(offsets[:-1], lengths)
+    return df
+
+
+def read_conll_files(data_files):
+    """Parse conll files into one data frame"""
+    columns = ConllColumns()
+    for data_file in data_files:
+        columns.add_file(data_file)
+    return get_frame(columns.get_arrays(), columns.files)
+
+
+def find_conll_files(path, suffix='gold_conll'):
+    """All files under path whose names end with suffix, sorted"""
+    data_files = []
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                directories.append(entry.path)
+            elif entry.name.endswith(suffix):
+                data_files.append(entry.path)
+    return sorted(data_files)
+
+
+def parse_chunk(data_files):
+    """Pool task. Parse a chunk of files into one set of columns"""
+    start = time.time()
+    columns = ConllColumns()
+    for data_file in data_files:
+        columns.add_file(data_file)
+    arrays = columns.get_arrays()
+    return os.getpid(), time.time() - start, arrays, columns.files
+
+
+def load_conll_files(data_files, threads=4, chunks_per_worker=8):
+    """Parse files with a pool of workers.
+       Returns ({column: array}, [(data_file, start_row, end_row)]), in the order of data_files
+    """
+    n_chunks = max(1, min(len(data_files), threads * chunks_per_worker))
+    chunks = [data_files[i * len(data_files) // n_chunks: (i + 1) * len(data_files) // n_chunks]
+              for i in range(n_chunks)]
+
+    start = time.time()
+    if threads > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(threads)
+        try:
+            results = list(pool.imap(parse_chunk, chunks))  # imap keeps the order of chunks
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [parse_chunk(chunk) for chunk in chunks]
+    elapsed = time.time() - start
+
+    files = []
+    n_rows = 0
+    worker_stats = defaultdict(lambda: [0, 0, 0.0])  # pid -> [files, tokens, busy seconds]
+    for pid, busy, arrays, chunk_files in results:
+        files += [(data_file, begin + n_rows, end + n_rows) for data_file, begin, end in chunk_files]
+        n_tokens = len(arrays['doc_id'])
+        n_rows += n_tokens
+        worker_stats[pid][0] += len(chunk_files)
+        worker_stats[pid][1] += n_tokens
+        worker_stats[pid][2] += busy
+    arrays = dict((column, np.concatenate([result[2][column] for result in results])) for column in COLUMNS)
+
+    print("Parsed %d files (%d tokens) in %.1fs" % (len(files), n_rows, elapsed))
+    for pid, (n_files, n_tokens, busy) in sorted(worker_stats.items()):
+        busy = max(busy, 1e-6)
+        print("  worker %d: %d files, %d tokens, %.1f files/s, %.0f tokens/s" % (
+            pid, n_files, n_tokens, n_files / busy, n_tokens / busy))
+    return arrays, files
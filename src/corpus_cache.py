@@ -0,0 +1,127 @@
+"""On-disk columnar cache of parsed CoNLL files.
+
+One compressed npz file is kept per corpus directory. String columns are stored as
+categorical codes plus their categories, and every source file is keyed by path, size
+and mtime so only files that changed since the last run need to be parsed again.
+"""
+from __future__ import print_function
+import os
+import numpy as np
+import pandas as pd
+
+from src.conll_reader import COLUMNS
+
+CACHE_VERSION = 1
+NUMERIC_COLUMNS = ('word_nb',)
+
+
+def get_cache_file(path, suffix):
+    return os.path.join(path, '.%s.cache.npz' % suffix)
+
+
+def get_file_key(data_file):
+    """(size, mtime) of a file, used to detect changes"""
+    stat = os.stat(data_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class CorpusCache(object):
+    def __init__(self, path, suffix='gold_conll', load=True):
+        self.cache_file = get_cache_file(path, suffix)
+        self.files = {}  # data_file -> (size, mtime, start_row, end_row)
+        self.columns = {}  # column -> (codes, categories) or numeric values
+        if load:
+            self.load()
+
+    def load(self):
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            with np.load(self.cache_file, allow_pickle=False) as data:
+                if int(data['version']) != CACHE_VERSION:
+                    print("Corpus cache %s is outdated, rebuilding it" % self.cache_file)
+                    return
+                # each member is decompressed on every access, so read them once
+                files = data['files'].tolist()
+                sizes = data['sizes'].tolist()
+                mtimes = data['mtimes'].tolist()
+                offsets = data['offsets'].tolist()
+                for i, data_file in enumerate(files):
+                    self.files[str(data_file)] = (sizes[i], mtimes[i], offsets[i], offsets[i + 1])
+                for column in COLUMNS:
+                    if column in NUMERIC_COLUMNS:
+                        self.columns[column] = data[column]
+                    else:
+                        self.columns[column] = (data[column + '_codes'],
+                                                data[column + '_categories'].astype(object))
+        except (IOError, ValueError, KeyError) as e:
+            print("Ignoring unreadable corpus cache %s: %s" % (self.cache_file, e))
+            self.files = {}
+            self.columns = {}
+
+    def stale_files(self, data_files):
+        """files which are new or changed since the cache was written"""
+        stale = []
+        for data_file in data_files:
+            if data_file not in self.files or self.files[data_file][:2] != get_file_key(data_file):
+                stale.append(data_file)
+        return stale
+
+    def get_column(self, column, start, end):
+        if column in NUMERIC_COLUMNS:
+            return self.columns[column][start:end]
+        codes, categories = self.columns[column]
+        return categories[codes[start:end]]
+
+    def update(self, data_files, parsed, parsed_files, save=True):
+        """Assemble the columns of data_files, and rewrite the cache if anything changed.
+           Returns ({column: array}, [(data_file, start_row, end_row)]) in the order of data_files
+           parsed: {column: array} of newly parsed files
+           parsed_files: [(data_file, start_row, end_row)] rows of each file in parsed
+        """
+        parsed_rows = dict((data_file, (start, end)) for data_file, start, end in parsed_files)
+        segments = []  # [from_parsed, start, end] runs of contiguous rows from the same source
+        files = []
+        for data_file in data_files:
+            from_parsed = data_file in parsed_rows
+            start, end = parsed_rows[data_file] if from_parsed else self.files[data_file][2:]
+            files.append((data_file, start, end))
+            if segments and segments[-1][0] == from_parsed and segments[-1][2] == start:
+                segments[-1][2] = end
+            else:
+                segments.append([from_parsed, start, end])
+
+        arrays = {}
+        for column in COLUMNS:
+            parts = [parsed[column][start:end] if from_parsed else self.get_column(column, start, end)
+                     for from_parsed, start, end in segments]
+            arrays[column] = np.concatenate(parts) if parts else np.empty(0, dtype=object)
+
+        if save and (parsed_files or set(self.files) != set(data_files)):
+            self.save(arrays, data_files, [end - start for _, start, end in files])
+        return arrays, files
+
+    def save(self, arrays, data_files, lengths):
+        data = {'version': np.array(CACHE_VERSION),
+                'files': np.array(data_files, dtype=str),
+                'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)}
+        keys = np.array([get_file_key(data_file) for data_file in data_files], dtype=np.int64).reshape(-1, 2)
+        data['sizes'] = keys[:, 0]
+        data['mtimes'] = keys[:, 1]
+        for column in COLUMNS:
+            if column in NUMERIC_COLUMNS:
+                data[column] = pd.to_numeric(pd.Series(arrays[column]), errors='coerce').fillna(-1).values.astype(np.int64)
+            else:
+                codes, categories = pd.factorize(arrays[column])
+                data[column + '_codes'] = codes.astype(np.int32)
+                data[column + '_categories'] = np.array(categories, dtype=str)
+
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez_compressed(f, **data)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            print("Could not write corpus cache %s: %s" % (self.cache_file, e))
+            return
+        print("Corpus cache saved to %s" % self.cache_file)
@@ -0,0 +1,59 @@
+"""Per-document index of a corpus data frame"""
+from __future__ import print_function
+import numpy as np
+import pandas as pd
+
+
+class DocumentStore(object):
+    """Maps each doc_id to its contiguous range of rows in the corpus data frame,
+       so selecting a document is a slice instead of a scan over the whole corpus.
+    """
+    def __init__(self, df):
+        doc_codes, doc_ids = pd.factorize(df.doc_id.values)
+        if len(doc_codes) and np.count_nonzero(np.diff(doc_codes)) + 1 != len(doc_ids):
+            # rows of some documents are not contiguous. Group them, keeping the order within documents
+            order = np.argsort(doc_codes, kind='mergesort')
+            df = df.iloc[order]
+            doc_codes = doc_codes[order]
+
+        self.df = df
+        self.doc_ids = np.asarray(doc_ids, dtype=object)  # in order of appearance, like df.doc_id.unique()
+        self.offsets = np.searchsorted(doc_codes, np.arange(len(doc_ids) + 1))
+        self.doc_index = dict((doc_id, i) for i, doc_id in enumerate(self.doc_ids))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_index
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def unique(self, column):
+        """distinct values of a column"""
+        return self.df[column].unique()
+
+    def mention_counts(self):
+        """number of mentions of each document, the opening brackets of its coref column"""
+        opened = np.concatenate([[0], np.cumsum(self.df.coref.str.count(r'\(').values)])
+        return opened[self.offsets[1:]] - opened[self.offsets[:-1]]
+
+    def get_range(self, doc_id):
+        """(start_row, end_row) of a document"""
+        i = self.doc_index[doc_id]
+        return self.offsets[i], self.offsets[i + 1]
+
+    def get(self, doc_id):
+        """data frame of a document, a slice of the corpus frame"""
+        start, end = self.get_range(doc_id)
+        return self.df.iloc[start:end]
+
+    __getitem__ = get
+
+
+def get_documents(corpus):
+    """DocumentStore of a corpus data frame. Document stores and compact corpora are returned as they are"""
+    if hasattr(corpus, 'get_range'):
+        return corpus
+    return DocumentStore(corpus)
@@ -3,7 +3,6 @@ import os
 import sys
 from collections import defaultdict
 import pickle
-import time
 import copy
 import re
 
@@ -12,6 +11,7 @@ from sklearn.metrics import classification_report
 from src.clustering import clustering
 
 from src.build_data import group_data, slice_data, BATCH_SIZE, replace_pronoun
+from src.document_store import get_documents
 from src.preprocess import SPEAKER_MAP
 FULL_OUTPUT = True
 
@@ -40,6 +40,8 @@ class Evaluator(object):
         return classification_report(Y_true, Y_pred, digits=3)
 
     def write_results(self, df, dest_path):
+        """df: corpus data frame, DocumentStore or CompactCorpus"""
+        documents = get_documents(df)
         n_files = len(self.test_data_q)
         print("# files: %d" % n_files)
         for i, data in enumerate(self.test_data_q):
@@ -57,7 +59,8 @@ class Evaluator(object):
                 pair_results[(key[1], key[2])] = pred[index_map[key]]
             locs, clusters, _ = clustering(pair_results)
             doc_id = key[0]
-            length = len(df.loc[df.doc_id == doc_id])
+            doc_start, doc_end = documents.get_range(doc_id)
+            length = doc_end - doc_start
 
             sys.stdout.write("Saving results %d / %d\r" % (i + 1, n_files))
             sys.stdout.flush()
@@ -116,14 +119,18 @@ class TriadEvaluator(object):
         return classification_report(Y_true, Y_pred, digits=3)
 
     def write_results(self, df, dest_path, n_iterations, save_dendrograms=True, clustering_only=False, compute_linkage=False):
-        """Perform evaluation on all test data, write results"""
+        """Perform evaluation on all test data, write results
+           df: corpus data frame, DocumentStore or CompactCorpus
+           test_input_gen must be an evaluation stream (see DataGen.generate_triad_eval), yielding every
+           document once
+        """
         # assert self.data_available
         print("# files: %d" % n_iterations)
 
         all_pairs_true = []
         all_pairs_pred = []
-        processed_docs = set([])
-        doc_ids = df.doc_id.unique()
+        documents = get_documents(df)
+        doc_ids = documents.doc_ids
         i = n_iterations
         t = 3.6
         method = 'average'
@@ -131,23 +138,14 @@ class TriadEvaluator(object):
 
         while i > 0:
             if not clustering_only:
-                test_data_q = next(self.test_input_gen)
-                assert len(test_data_q) == 1  # only process one file
-                if not test_data_q[0]:
+                doc_id, datum = next(self.test_input_gen)
+                if not datum or not len(datum[1]):  # no triads in the document
                     i -= 1
                     continue
-                X, y, index_map = test_data_q[0]
+                X, y, index_map = datum
                 if y.shape[-1] == 3:
                     y = y[:, 1:]
 
-                doc_id = list(index_map.keys())[0][0]  # python3 does not support keys() as a list
-
-
-                if doc_id in processed_docs:
-                    # print("%s already processed before!" % doc_id)
-                    time.sleep(10)
-                    continue
-                processed_docs.add(doc_id)
                 pred = []
                 for X, _ in slice_data([X, y], 50):  # do this to avoid very large batches
                     pred.append(self.model.predict(X))
@@ -170,7 +168,7 @@ class TriadEvaluator(object):
                 # save raw scores
                 pickle.dump(pair_results, open(os.path.join(dest_path, 'raw_scores', doc_id.split('/')[-1]+'results.pkl'), 'wb'))
 
-                doc_df = df.loc[df.doc_id == doc_id]
+                doc_df = documents.get(doc_id)
                 doc_df = doc_df.reset_index()
                 original_doc_df = copy.copy(doc_df)
                 replace_pronoun(doc_df)
@@ -195,7 +193,7 @@ class TriadEvaluator(object):
                 from scipy.cluster.hierarchy import inconsistent, fcluster
                 doc_id = doc_ids[i - 1]
 
-                doc_df = df.loc[df.doc_id == doc_id]
+                doc_df = documents.get(doc_id)
                 doc_df = doc_df.reset_index()
                 original_doc_df = copy.copy(doc_df)
                 replace_pronoun(doc_df)
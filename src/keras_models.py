@@ -297,10 +297,14 @@ def train(**kwargs):
     model_destination = kwargs['model_destination']
     epochs = kwargs['epochs']
     load_model = kwargs['load_model']
+    dataset = kwargs.get('dataset')  # compiled TriadDataset of train_gen
 
 
     group_size = 40
-    train_input_gen = train_gen.generate_triad_input(file_batch=50)
+    if dataset is not None:
+        train_input_gen = dataset.generate_triad_input(file_batch=50, compact=False)
+    else:
+        train_input_gen = train_gen.generate_triad_input(file_batch=50)
 
     if val_dir is not None:
         # Need the same word indexes and pos indexes for training and test data
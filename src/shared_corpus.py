@@ -0,0 +1,84 @@
+"""Corpus in shared memory.
+
+Generation workers used to inherit the corpus by fork. The pages of a data frame are touched by
+reference counting and pandas caches, so each worker slowly copied the whole corpus. A SharedCorpus
+copies the integer arrays of a CompactCorpus (token codes, mentions and the document ranges) into
+multiprocessing.shared_memory blocks once, and exposes them as read-only numpy views. Forked workers
+map the same pages, and a pickled SharedCorpus only carries the names of its blocks, so a spawned
+process attaches to them instead of receiving a copy of the corpus.
+"""
+from __future__ import print_function
+import numpy as np
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+from src.compact_corpus import CompactCorpus, CODED_COLUMNS
+
+SHARED_ARRAYS = ['word_nb', 'doc_ranges', 'mention_ranges', 'mention_starts', 'mention_ends', 'mention_clusters']
+
+
+class SharedCorpus(CompactCorpus):
+    """Read-only CompactCorpus in shared memory blocks, with the same document interface.
+       The process that creates it owns the blocks and frees them with close()
+    """
+    def __init__(self, corpus):
+        """corpus: CompactCorpus, TokenStore or corpus data frame to copy"""
+        if shared_memory is None:
+            raise RuntimeError("a shared corpus needs multiprocessing.shared_memory, python 3.8 or later")
+        if not isinstance(corpus, CompactCorpus):
+            corpus = CompactCorpus.from_frame(corpus)
+        arrays = dict((name, np.asarray(getattr(corpus, name))) for name in SHARED_ARRAYS)
+        for column in CODED_COLUMNS:
+            arrays['codes_' + column] = np.asarray(corpus.codes[column])
+
+        self.df = None
+        self.doc_ids = corpus.doc_ids
+        self.vocabs = corpus.vocabs
+        self.owner = True
+        self.blocks = {}
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = (block, array.dtype.str, array.shape)
+        self.attach()
+
+    def attach(self):
+        """read-only views of the blocks, and the index of the doc_ids"""
+        views = {}
+        for name, (block, dtype, shape) in self.blocks.items():
+            views[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+            views[name].setflags(write=False)
+        for name in SHARED_ARRAYS:
+            setattr(self, name, views[name])
+        self.codes = dict((column, views['codes_' + column]) for column in CODED_COLUMNS)
+        self.doc_index = dict((doc_id, i) for i, doc_id in enumerate(self.doc_ids))
+
+    def __getstate__(self):
+        """the names of the blocks, the doc_ids and the vocabularies"""
+        blocks = dict((name, (block.name, dtype, shape)) for name, (block, dtype, shape) in self.blocks.items())
+        return {'doc_ids': self.doc_ids, 'vocabs': self.vocabs, 'blocks': blocks}
+
+    def __setstate__(self, state):
+        self.df = None
+        self.doc_ids = state['doc_ids']
+        self.vocabs = state['vocabs']
+        self.owner = False
+        self.blocks = dict((name, (shared_memory.SharedMemory(name=block_name), dtype, shape))
+                           for name, (block_name, dtype, shape) in state['blocks'].items())
+        self.attach()
+
+    def close(self):
+        """Detach from the blocks, the owner also frees them. The corpus must not be used any more"""
+        for name in SHARED_ARRAYS:
+            setattr(self, name, None)
+        self.codes = {}
+        for block, _, _ in self.blocks.values():
+            try:
+                block.close()
+            except BufferError:  # views of the corpus are still used, the memory is freed with them
+                pass
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
@@ -0,0 +1,299 @@
+"""Out-of-core token store.
+
+The integer coded corpus (see compact_corpus.py) is written to a directory of fixed-width
+binary arrays, plus a row range index per document. TokenStore memory-maps the arrays, so
+documents are paged in lazily and resident memory does not grow with the corpus size.
+Only the vocabularies and the document index are kept in memory.
+
+Stores are append-only. Ingesting a changed file appends its documents again and points
+the index at the new rows; vocabulary codes are never renumbered. Documents of deleted files,
+and documents a changed file no longer contains, are dropped from the index.
+
+Each ingest writes a new index directory, then commits it by replacing meta.json, which names it
+and the sizes of the arrays. A crash before that leaves the previous index and sizes in place, and the
+next ingest drops the rows written after them.
+
+Layout of a store directory:
+    meta.json                        format version, sizes and the generation of the index
+    word_nb.int32, <column>.int32    one value per token
+    mention_{starts,ends}.int64      global rows of the mentions, in the order they are opened
+    mention_clusters.int32
+    index.<generation>/
+        manifest.json                size, mtime and doc_ids of every ingested file, ingest history
+        doc_ids.txt                  one doc_id per line
+        doc_ranges.int64             (n_docs, 2) start and end rows of each document
+        mention_ranges.int64         (n_docs, 2) start and end mentions of each document
+        vocab_<column>.txt           one value per line, line number is the code
+"""
+from __future__ import print_function
+import io
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+from src.compact_corpus import CompactCorpus, CODED_COLUMNS, parse_coref_spans
+from src.conll_reader import find_conll_files, load_conll_files
+from src.corpus_cache import get_file_key
+
+STORE_VERSION = 4  # 3: mentions opened on the same row keep their order, 4: index directories
+TOKEN_ARRAYS = [('word_nb', np.int32)] + [(column, np.int32) for column in CODED_COLUMNS]
+MENTION_ARRAYS = [('mention_starts', np.int64), ('mention_ends', np.int64), ('mention_clusters', np.int32)]
+
+
+def read_lines(file_name):
+    with io.open(file_name, encoding='utf-8', newline='\n') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def write_lines(file_name, lines):
+    with io.open(file_name, 'w', encoding='utf-8', newline='\n') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def read_json(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def write_json(file_name, data):
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, file_name)
+
+
+def array_file(store_dir, name, dtype):
+    return os.path.join(store_dir, name + '.' + np.dtype(dtype).name)
+
+
+def open_array(file_name, dtype):
+    """read-only memory map of a binary array file"""
+    if os.path.getsize(file_name) == 0:
+        return np.zeros(0, dtype=dtype)  # mmap cannot map empty files
+    return np.memmap(file_name, dtype=dtype, mode='r')
+
+
+def get_index_dir(store_dir, generation):
+    return os.path.join(store_dir, 'index.%d' % generation)
+
+
+def read_ranges(file_name):
+    return np.fromfile(file_name, dtype=np.int64).reshape(-1, 2)
+
+
+def check_version(store_dir, meta):
+    if meta['version'] != STORE_VERSION:
+        raise ValueError("token store %s has version %s, expected %d" % (store_dir, meta['version'], STORE_VERSION))
+
+
+class TokenStoreWriter(object):
+    """Writes a token store chunk by chunk, so the corpus never has to fit in memory.
+       append: add to the existing store in store_dir instead of starting a new one
+    """
+    def __init__(self, store_dir, append=False):
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.vocabs = dict((column, {}) for column in CODED_COLUMNS)
+        self.doc_ids = []
+        self.doc_ranges = []
+        self.mention_ranges = []
+        self.n_tokens = 0
+        self.n_mentions = 0
+        self.generation = 0
+        self.manifest = {'files': {}, 'ingests': []}
+        self.added_docs = []
+        self.removed_docs = []
+        if append:
+            self.load()
+        self.doc_index = dict((doc_id, i) for i, doc_id in enumerate(self.doc_ids))
+
+        self.files = {}
+        for name, dtype in TOKEN_ARRAYS + MENTION_ARRAYS:
+            file_name = array_file(store_dir, name, dtype)
+            if append:
+                with open(file_name, 'ab') as f:  # drop rows of an interrupted ingest
+                    n_rows = self.n_mentions if name.startswith('mention_') else self.n_tokens
+                    f.truncate(n_rows * np.dtype(dtype).itemsize)
+            self.files[name] = open(file_name, 'ab' if append else 'wb')
+
+    def load(self):
+        """state of the existing store"""
+        meta = read_json(os.path.join(self.store_dir, 'meta.json'))
+        check_version(self.store_dir, meta)
+        self.n_tokens = meta['n_tokens']
+        self.n_mentions = meta['n_mentions']
+        self.generation = meta['generation']
+        index_dir = get_index_dir(self.store_dir, self.generation)
+        self.doc_ids = read_lines(os.path.join(index_dir, 'doc_ids.txt'))
+        self.doc_ranges = read_ranges(os.path.join(index_dir, 'doc_ranges.int64')).tolist()
+        self.mention_ranges = read_ranges(os.path.join(index_dir, 'mention_ranges.int64')).tolist()
+        for column in CODED_COLUMNS:
+            vocab = read_lines(os.path.join(index_dir, 'vocab_%s.txt' % column))
+            self.vocabs[column] = dict((value, i) for i, value in enumerate(vocab))
+        self.manifest = read_json(os.path.join(index_dir, 'manifest.json'))
+
+    def add(self, arrays, files=None):
+        """Append a chunk of parsed columns ({column: array}, documents complete and contiguous).
+           Documents already in the store are replaced by the new version.
+           files: [(data_file, start_row, end_row)] of the chunk, recorded in the manifest
+        """
+        doc_codes, doc_ids = pd.factorize(np.asarray(arrays['doc_id']))
+        if len(doc_codes) and np.count_nonzero(np.diff(doc_codes)) + 1 != len(doc_ids):
+            raise ValueError("rows of a document are not contiguous")
+        local_offsets = np.searchsorted(doc_codes, np.arange(len(doc_ids) + 1))
+
+        word_nb = pd.to_numeric(np.asarray(arrays['word_nb']), errors='coerce').astype(np.float64)
+        np.where(np.isnan(word_nb), -1, word_nb).astype(np.int32).tofile(self.files['word_nb'])
+        for column in CODED_COLUMNS:
+            codes, uniques = pd.factorize(np.asarray(arrays[column]))
+            vocab = self.vocabs[column]
+            ids = np.array([vocab.setdefault(value, len(vocab)) for value in uniques], dtype=np.int32)
+            ids[codes].tofile(self.files[column])
+
+        starts, ends, clusters = parse_coref_spans(np.asarray(arrays['coref'], dtype=object), local_offsets)
+        (starts + self.n_tokens).tofile(self.files['mention_starts'])
+        (ends + self.n_tokens).tofile(self.files['mention_ends'])
+        clusters.tofile(self.files['mention_clusters'])
+        doc_ranges = np.stack([local_offsets[:-1], local_offsets[1:]], axis=-1) + self.n_tokens
+        mention_offsets = np.searchsorted(starts, local_offsets)
+        mention_ranges = np.stack([mention_offsets[:-1], mention_offsets[1:]], axis=-1) + self.n_mentions
+
+        for doc_id, doc_range, mention_range in zip(doc_ids, doc_ranges.tolist(), mention_ranges.tolist()):
+            i = self.doc_index.get(doc_id)
+            if i is None:
+                self.doc_index[doc_id] = len(self.doc_ids)
+                self.doc_ids.append(doc_id)
+                self.doc_ranges.append(doc_range)
+                self.mention_ranges.append(mention_range)
+            else:  # the rows of the old version stay in the arrays, but are no longer indexed
+                self.doc_ranges[i] = doc_range
+                self.mention_ranges[i] = mention_range
+            self.added_docs.append(doc_id)
+        self.n_tokens += int(local_offsets[-1])
+        self.n_mentions += len(starts)
+
+        for data_file, start, end in files or []:
+            size, mtime_ns = get_file_key(data_file)
+            file_doc_ids = list(pd.unique(arrays['doc_id'][start:end]))
+            entry = self.manifest['files'].get(data_file)
+            if entry is not None:  # documents the file no longer contains
+                self.remove(set(entry['doc_ids']) - set(file_doc_ids))
+            self.manifest['files'][data_file] = {'size': size, 'mtime_ns': mtime_ns, 'doc_ids': file_doc_ids}
+
+    def remove(self, doc_ids):
+        """Drop documents from the index. Like replaced documents, their rows stay in the arrays"""
+        doc_ids = set(doc_ids) & set(self.doc_index)
+        if not doc_ids:
+            return
+        kept = [i for i, doc_id in enumerate(self.doc_ids) if doc_id not in doc_ids]
+        self.doc_ids = [self.doc_ids[i] for i in kept]
+        self.doc_ranges = [self.doc_ranges[i] for i in kept]
+        self.mention_ranges = [self.mention_ranges[i] for i in kept]
+        self.doc_index = dict((doc_id, i) for i, doc_id in enumerate(self.doc_ids))
+        self.removed_docs += sorted(doc_ids)
+
+    def remove_files(self, data_files):
+        """Drop ingested files, e.g. deleted ones, and their documents"""
+        for data_file in data_files:
+            self.remove(self.manifest['files'].pop(data_file)['doc_ids'])
+
+    def close(self):
+        """Write the index to a new directory and commit it with meta.json, then remove the older ones"""
+        for f in self.files.values():
+            f.close()
+        generation = self.generation + 1
+        index_dir = get_index_dir(self.store_dir, generation)
+        shutil.rmtree(index_dir, ignore_errors=True)  # left by an interrupted ingest
+        os.makedirs(index_dir)
+        write_lines(os.path.join(index_dir, 'doc_ids.txt'), self.doc_ids)
+        np.array(self.doc_ranges, dtype=np.int64).tofile(os.path.join(index_dir, 'doc_ranges.int64'))
+        np.array(self.mention_ranges, dtype=np.int64).tofile(os.path.join(index_dir, 'mention_ranges.int64'))
+        for column in CODED_COLUMNS:
+            vocab = sorted(self.vocabs[column], key=self.vocabs[column].get)
+            write_lines(os.path.join(index_dir, 'vocab_%s.txt' % column), vocab)
+
+        indexed_tokens = sum(end - start for start, end in self.doc_ranges)
+        self.manifest['ingests'].append({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                         'documents_added': len(self.added_docs),
+                                         'documents_removed': len(self.removed_docs),
+                                         'documents': len(self.doc_ids), 'tokens': indexed_tokens})
+        write_json(os.path.join(index_dir, 'manifest.json'), self.manifest)
+        # meta.json is replaced last and at once, a store without it is incomplete
+        write_json(os.path.join(self.store_dir, 'meta.json'),
+                   {'version': STORE_VERSION, 'generation': generation, 'n_docs': len(self.doc_ids),
+                    'n_tokens': self.n_tokens, 'n_mentions': self.n_mentions,
+                    'n_unindexed_tokens': self.n_tokens - indexed_tokens})
+        self.generation = generation
+        for name in os.listdir(self.store_dir):
+            if name.startswith('index.') and name != os.path.basename(index_dir):
+                shutil.rmtree(os.path.join(self.store_dir, name), ignore_errors=True)
+
+
+class TokenStore(CompactCorpus):
+    """Memory-mapped token store, with the same document interface as CompactCorpus"""
+    def __init__(self, store_dir):
+        meta = read_json(os.path.join(store_dir, 'meta.json'))
+        check_version(store_dir, meta)
+
+        self.store_dir = store_dir
+        self.df = None
+        index_dir = get_index_dir(store_dir, meta['generation'])
+        self.doc_ids = np.array(read_lines(os.path.join(index_dir, 'doc_ids.txt')), dtype=object)
+        self.doc_index = dict((doc_id, i) for i, doc_id in enumerate(self.doc_ids))
+        self.doc_ranges = read_ranges(os.path.join(index_dir, 'doc_ranges.int64'))
+        self.mention_ranges = read_ranges(os.path.join(index_dir, 'mention_ranges.int64'))
+        self.vocabs = {}
+        self.codes = {}
+        for column in CODED_COLUMNS:
+            self.vocabs[column] = np.array(read_lines(os.path.join(index_dir, 'vocab_%s.txt' % column)), dtype=object)
+            self.codes[column] = open_array(array_file(store_dir, column, np.int32), np.int32)
+        self.word_nb = open_array(array_file(store_dir, 'word_nb', np.int32), np.int32)
+        for name, dtype in MENTION_ARRAYS:
+            setattr(self, name, open_array(array_file(store_dir, name, dtype), dtype))
+        assert len(self.word_nb) == meta['n_tokens'] and len(self.mention_starts) == meta['n_mentions']
+
+
+def changed_files(data_files, manifest):
+    """files not in the manifest, or modified since they were ingested"""
+    changed = []
+    for data_file in data_files:
+        entry = manifest['files'].get(data_file)
+        if entry is None or (entry['size'], entry['mtime_ns']) != get_file_key(data_file):
+            changed.append(data_file)
+    return changed
+
+
+def ingest(path, store_dir, suffix='gold_conll', threads=4, files_per_chunk=200):
+    """Add the new and changed *suffix files under path to a token store, creating the store if needed.
+       Returns (TokenStore, doc_ids of the added or replaced documents)
+    """
+    append = os.path.isfile(os.path.join(store_dir, 'meta.json'))
+    writer = TokenStoreWriter(store_dir, append=append)
+    data_files = find_conll_files(path, suffix)
+    to_ingest = changed_files(data_files, writer.manifest)
+    deleted = [data_file for data_file in writer.manifest['files'] if not os.path.isfile(data_file)]
+    print('%d conll files found in %s, %d new or changed, %d deleted' % (
+        len(data_files), path, len(to_ingest), len(deleted)))
+    writer.remove_files(deleted)
+
+    for i in range(0, len(to_ingest), files_per_chunk):
+        arrays, files = load_conll_files(to_ingest[i:i + files_per_chunk], threads=threads)
+        writer.add(arrays, files)
+    writer.close()
+    print("token store %s: %d documents added or replaced, %d removed, %d documents, %d tokens" % (
+        store_dir, len(writer.added_docs), len(writer.removed_docs), len(writer.doc_ids), writer.n_tokens))
+    return TokenStore(store_dir), writer.added_docs
+
+
+def build_token_store(path, store_dir, suffix='gold_conll', threads=4, files_per_chunk=200):
+    """Parse all *suffix files under path into a new token store, one chunk of files at a time"""
+    meta_file = os.path.join(store_dir, 'meta.json')
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+    store, _ = ingest(path, store_dir, suffix=suffix, threads=threads, files_per_chunk=files_per_chunk)
+    return store
@@ -10,17 +10,40 @@ import sys
 import numpy as np
 import pickle
 
-from src.build_data import build_dataFrame, DataGen, slice_data, EMBEDDING_DIM
+from src.build_data import build_dataFrame, DataGen, slice_data, TriadBatch, EMBEDDING_DIM
+from src.vocabulary import HashedVocabulary
 from src.evaluator import TriadEvaluator
+from src.triad_loader import TriadLoader
 from src.attention import Attention
 
+class HashedEmbedding(nn.Module):
+    """Embedding of hashed words: sums the vectors of the buckets of each word, like an EmbeddingBag in sum mode.
+       Input (batch, length, bag size) buckets, bucket 0 is padding. Output (batch, length, embedding dim)
+    """
+    def __init__(self, n_buckets, embedding_dim):
+        super(HashedEmbedding, self).__init__()
+        self.Embedding = nn.Embedding(n_buckets, embedding_dim, padding_idx=0)
+
+    @property
+    def weight(self):
+        return self.Embedding.weight
+
+    def forward(self, input_buckets):
+        return self.Embedding(input_buckets).sum(dim=-2)
+
+
 class CorefTagger(nn.Module):
-    def __init__(self, vocab_size, pos_size, word_embeddings=None):
+    def __init__(self, vocab_size, pos_size, word_embeddings=None, hashed=False):
+        """hashed: words are inputs of a HashedVocabulary with vocab_size + 1 buckets"""
         super(CorefTagger, self).__init__()
         self.vocab_size = vocab_size
         self.pos_size = pos_size
 
-        self.WordEmbedding = nn.Embedding(self.vocab_size + 1, EMBEDDING_DIM)
+        if hashed:
+            assert word_embeddings is None, "hashed word embeddings are trained from scratch"
+            self.WordEmbedding = HashedEmbedding(self.vocab_size + 1, EMBEDDING_DIM)
+        else:
+            self.WordEmbedding = nn.Embedding(self.vocab_size + 1, EMBEDDING_DIM)
         if word_embeddings is not None:
             self.WordEmbedding.weight = nn.Parameter(torch.from_numpy(word_embeddings).type(torch.cuda.FloatTensor))
         # print("word embedding size:", self.WordEmbedding.weight.size())
@@ -408,6 +431,68 @@ class CorefTaggerCNN(CorefTagger):
 
         return individual_loss, transitivity_loss
 
+def get_word_embedding(model):
+    """word embedding layer of a model, or of the tagger a review model wraps"""
+    return getattr(model, 'coref_tagger', model).WordEmbedding
+
+
+def set_word_embeddings(model, embedding_matrix, float16=False):
+    """Replace the word embedding table of a model, e.g. by a trimmed one.
+       float16: store the table in half precision. load_torch_model converts it back
+    """
+    tagger = getattr(model, 'coref_tagger', model)
+    assert not isinstance(tagger.WordEmbedding, HashedEmbedding), "hashed embeddings have a fixed size"
+    old_weight = tagger.WordEmbedding.weight
+    weight = torch.from_numpy(np.ascontiguousarray(embedding_matrix, dtype=np.float32)).to(old_weight.device)
+    tagger.WordEmbedding = nn.Embedding(len(embedding_matrix), embedding_matrix.shape[1])
+    tagger.WordEmbedding.weight = nn.Parameter(weight.half() if float16 else weight)
+    tagger.vocab_size = len(embedding_matrix) - 1
+
+    # the optimizers are saved with the model, they must not keep the old table
+    for optimizer in (getattr(model, 'optimizer', None), getattr(tagger, 'optimizer', None)):
+        if optimizer is not None:
+            for group in optimizer.param_groups:
+                group['params'] = [tagger.WordEmbedding.weight if param is old_weight else param for param in group['params']]
+            optimizer.state.pop(old_weight, None)
+
+
+def load_torch_model(model_file):
+    """Load a saved model. A word embedding table stored in half precision is converted to float32"""
+    model = torch.load(model_file)
+    word_embedding = get_word_embedding(model)
+    if word_embedding.weight.dtype == torch.float16:
+        word_embedding.float()
+    return model
+
+
+def get_mention_tensors(mentions):
+    """mention table of a TriadBatch on the gpu, copied once for all its slices"""
+    return dict((key, torch.from_numpy(np.asarray(value)).type(torch.cuda.LongTensor)) for key, value in mentions.items())
+
+
+def expand_triads(mention_tensors, triads):
+    """The 15 model inputs of a TriadBatch, gathered on the gpu with index_select.
+       mention_tensors: see get_mention_tensors
+       triads: (n triads, 3) mention indexes
+    """
+    triads = torch.from_numpy(np.asarray(triads)).type(torch.cuda.LongTensor)
+    a, b, c = triads[:, 0], triads[:, 1], triads[:, 2]
+
+    def select(key, indexes):
+        return mention_tensors[key].index_select(0, indexes)
+
+    mention_spans = [select('start', a) - select('start', b), select('end', a) - select('end', b),
+                     select('start', b) - select('start', c), select('end', b) - select('end', c),
+                     select('start', a) - select('start', c), select('end', a) - select('end', c)]
+    speaker_identities = [(select('speaker', a) == select('speaker', b)).long(),
+                          (select('speaker', b) == select('speaker', c)).long(),
+                          (select('speaker', c) == select('speaker', a)).long()]
+    X = [x.unsqueeze(-1) for x in mention_spans + speaker_identities]
+    X += [select('words', a), select('words', b), select('words', c),
+          select('pos', a), select('pos', b), select('pos', c)]
+    return [autograd.Variable(x) for x in X]
+
+
 def train(**kwargs):
     train_gen = kwargs['train_gen']
     val_dir = kwargs['val_dir']
@@ -415,120 +500,146 @@ def train(**kwargs):
     epochs = kwargs['epochs']
     load_model = kwargs['load_model']
     review = kwargs.get('review', False)
+    dataset = kwargs.get('dataset')  # compiled TriadDataset of train_gen
 
     group_size = 100
-    train_input_gen = train_gen.generate_triad_input(file_batch=50, threads=3)
+    val_input_gen = None
+    if dataset is not None:
+        train_input_gen = dataset.generate_triad_input(file_batch=50, compact=True)
+    else:
+        train_input_gen = TriadLoader(train_gen, file_batch=50, threads=3, compact=True, shared_memory=True).start()
 
-    assert torch.cuda.is_available()
-    if review:
-        if load_model:
-            model = torch.load(os.path.join(model_destination, 'review', 'model.pt'))
+    try:
+        assert torch.cuda.is_available()
+        if review:
+            if load_model:
+                model = torch.load(os.path.join(model_destination, 'review', 'model.pt'))
+            else:
+                model = CorefTaggerReview(torch.load(os.path.join(model_destination, 'model.pt')))
+            model_destination = os.path.join(model_destination, 'review/')
+            if not os.path.exists(model_destination):
+                os.makedirs(model_destination)
+        elif load_model:
+            model = torch.load(os.path.join(model_destination, 'model.pt'))
         else:
-            model = CorefTaggerReview(torch.load(os.path.join(model_destination, 'model.pt')))
-        model_destination = os.path.join(model_destination, 'review/')
-        if not os.path.exists(model_destination):
-            os.makedirs(model_destination)
-    elif load_model:
-        model = torch.load(os.path.join(model_destination, 'model.pt'))
-    else:
-        model = CorefTagger(len(train_gen.word_indexes), len(train_gen.pos_tags), word_embeddings=train_gen.embedding_matrix)
-        # model = CorefTaggerCNN(len(train_gen.word_indexes), len(train_gen.pos_tags),
-        #                     word_embeddings=train_gen.embedding_matrix)
-    model = model.cuda()
-    print("Model loaded successfully.")
-    training_history = []
-    evaluator = None
-
-    if val_dir is not None:
-        # Need the same word indexes and pos indexes for training and test data
-        val_gen = DataGen(build_dataFrame(val_dir, threads=1), train_gen.word_indexes, train_gen.pos_tags)
-        val_input_gen = val_gen.generate_triad_input(file_batch=20, looping=True, threads=2)  # file_batch is the # files to use
-        print("val_input_gen created.")
-        # just get data from 1 for try
-        val_data_q = next(val_input_gen)
-        print("val_data_q created.")
-        val_data = val_data_q[0]
-        # val_X, val_y = next(group_data(val_data, group_size, batch_size=None))
-        val_X, val_y = val_data
-        val_X = [autograd.Variable(torch.from_numpy(x).type(torch.cuda.LongTensor)) for x in val_X]
-        val_y = autograd.Variable(torch.from_numpy(val_y).type(torch.cuda.FloatTensor))
-        print("val data created.")
-
-    # optimizer = optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), lr=0.01, weight_decay=1e-4)
-    if load_model:
-        for g in model.optimizer.param_groups:
-            g['lr'] = 0.005
-    for epoch in range(epochs):
-        sys.stdout.write('\n')
-        # train_data_q = subproc_queue.get()
-        train_data_q = next(train_input_gen)
-        n_training_files = len(train_data_q)
-        # epoch_history = []
-        start = time.time()
-        model.train()
-        history = {'acc': [], 'loss': [], 'trans_loss': [], 'val_acc': [], 'val_loss': [], 'val_trans_loss': []}
-        for n, data in enumerate(train_data_q):
-            for X, y in slice_data(data, group_size):  # create batches
-                if not y.any(): continue
-
-                X = [autograd.Variable(torch.from_numpy(x).type(torch.cuda.LongTensor)) for x in X]
-                y = autograd.Variable(torch.from_numpy(y).type(torch.cuda.FloatTensor))
-
-                loss, acc = model.fit(X, y)
-                val_loss, val_acc = model.evaluate(val_X, val_y)
-
-                history['loss'].append(loss)
-                history['acc'].append(acc)
-                history['val_loss'].append(val_loss)
-                history['val_acc'].append(val_acc)
-
-            acc = np.mean(history['acc'])
-            loss = np.mean(history['loss'])
-            val_acc = np.mean(history['val_acc'])
-            val_loss = np.mean(history['val_loss'])
-
-            sys.stdout.write(
-                "epoch %d after training file %d/%d--- -%ds - loss : %.4f - acc : %.4f - val_loss : %.4f - val_acc : %.4f\r" % (
-                    epoch + 1, n + 1, n_training_files, int(time.time() - start), loss, acc, val_loss, val_acc))
-            sys.stdout.flush()
-
-        training_history.append({'categorical_accuracy': acc, 'loss': loss})
-        if (epoch +1) % 10 == 0:
-            torch.save(model, os.path.join(model_destination, 'model.pt'))
-
-            if val_dir:
-                if evaluator is None:
-                    model.eval()
-                    evaluator = TriadEvaluator(model, val_input_gen)
-                    # evaluator.data_available = True
-                    # filler = multiprocessing.Process(target=evaluator.fill_q_store, args=())
-                    # filler.daemon = True
-                    # filler.start()
-                else:
-                    evaluator.model = model
-                    evaluator.model.eval()
-
-                eval_results = evaluator.fast_eval()
-                # print("\nlabel constraint factor:", model.c)
-                print(eval_results)
-
-            if epoch + 1 == 150:
-                if load_model:
-                    lr = 0.002
-                else:
-                    lr = 0.005
-                for g in model.optimizer.param_groups:
-                    g['lr'] = lr
-
-            if epoch + 1 == 300:
-                for g in model.optimizer.param_groups:
-                    g['lr'] = 0.002
-
-    eval_results = evaluator.fast_eval()
-    print(eval_results)
-    # with open(os.path.join(args.model_destination, 'results.pkl'), 'w') as f:
-    #     pickle.dump(eval_results, f)
-    with open(os.path.join(model_destination, 'history.pkl'), 'wb') as f:
-        pickle.dump(training_history, f)
+            model = CorefTagger(len(train_gen.word_indexes), len(train_gen.pos_tags), word_embeddings=train_gen.embedding_matrix,
+                                hashed=isinstance(train_gen.word_indexes, HashedVocabulary))
+            # model = CorefTaggerCNN(len(train_gen.word_indexes), len(train_gen.pos_tags),
+            #                     word_embeddings=train_gen.embedding_matrix)
+        model = model.cuda()
+        print("Model loaded successfully.")
+        training_history = []
+        evaluator = None
+
+        if val_dir is not None:
+            # Need the same word indexes and pos indexes for training and test data
+            val_gen = DataGen(build_dataFrame(val_dir, threads=1), train_gen.word_indexes, train_gen.pos_tags)
+            # file_batch is the # files to use
+            val_input_gen = TriadLoader(val_gen, file_batch=20, looping=True, threads=2).start()
+            print("val_input_gen created.")
+            # just get data from 1 for try
+            val_data_q = next(val_input_gen)
+            print("val_data_q created.")
+            val_data = val_data_q[0]
+            # val_X, val_y = next(group_data(val_data, group_size, batch_size=None))
+            val_X, val_y = val_data
+            val_X = [autograd.Variable(torch.from_numpy(x).type(torch.cuda.LongTensor)) for x in val_X]
+            val_y = autograd.Variable(torch.from_numpy(val_y).type(torch.cuda.FloatTensor))
+            print("val data created.")
+
+        # optimizer = optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), lr=0.01, weight_decay=1e-4)
+        if load_model:
+            for g in model.optimizer.param_groups:
+                g['lr'] = 0.005
+        for epoch in range(epochs):
+            sys.stdout.write('\n')
+            # train_data_q = subproc_queue.get()
+            train_data_q = next(train_input_gen)
+            n_training_files = len(train_data_q)
+            # epoch_history = []
+            start = time.time()
+            model.train()
+            history = {'acc': [], 'loss': [], 'trans_loss': [], 'val_acc': [], 'val_loss': [], 'val_trans_loss': []}
+            for n, data in enumerate(train_data_q):
+                mention_tensors = None
+                for X, y in slice_data(data, group_size):  # create batches
+                    if not y.any(): continue
+
+                    if isinstance(X, TriadBatch):
+                        if mention_tensors is None:
+                            mention_tensors = get_mention_tensors(X.mentions)
+                        X = expand_triads(mention_tensors, X.triads)
+                    else:
+                        X = [autograd.Variable(torch.from_numpy(x).type(torch.cuda.LongTensor)) for x in X]
+                    y = autograd.Variable(torch.from_numpy(y).type(torch.cuda.FloatTensor))
+
+                    loss, acc = model.fit(X, y)
+                    val_loss, val_acc = model.evaluate(val_X, val_y)
+
+                    history['loss'].append(loss)
+                    history['acc'].append(acc)
+                    history['val_loss'].append(val_loss)
+                    history['val_acc'].append(val_acc)
+
+                acc = np.mean(history['acc'])
+                loss = np.mean(history['loss'])
+                val_acc = np.mean(history['val_acc'])
+                val_loss = np.mean(history['val_loss'])
+
+                sys.stdout.write(
+                    "epoch %d after training file %d/%d--- -%ds - loss : %.4f - acc : %.4f - val_loss : %.4f - val_acc : %.4f\r" % (
+                        epoch + 1, n + 1, n_training_files, int(time.time() - start), loss, acc, val_loss, val_acc))
+                sys.stdout.flush()
+
+            training_history.append({'categorical_accuracy': acc, 'loss': loss})
+            if (epoch +1) % 10 == 0:
+                torch.save(model, os.path.join(model_destination, 'model.pt'))
+                if isinstance(train_input_gen, TriadLoader):
+                    queued, fill = train_input_gen.queue_fill()
+                    print("\nprefetch queue %.1f MB (%d%% full), %d spilled, worker private memory %s MB" % (
+                        queued / 1e6, 100 * fill, train_input_gen.n_spilled,
+                        ' '.join('%.0f' % (memory or 0) for memory in train_input_gen.memory_usage(private=True))))
+                    busy, wait_time = train_input_gen.utilization()
+                    print("workers busy %s%%, waited %ds for training data" % (
+                        ' '.join('%.0f' % (100 * fraction) for fraction in busy), wait_time))
+
+                if val_dir:
+                    if evaluator is None:
+                        model.eval()
+                        evaluator = TriadEvaluator(model, val_input_gen)
+                        # evaluator.data_available = True
+                        # filler = multiprocessing.Process(target=evaluator.fill_q_store, args=())
+                        # filler.daemon = True
+                        # filler.start()
+                    else:
+                        evaluator.model = model
+                        evaluator.model.eval()
+
+                    eval_results = evaluator.fast_eval()
+                    # print("\nlabel constraint factor:", model.c)
+                    print(eval_results)
+
+                if epoch + 1 == 150:
+                    if load_model:
+                        lr = 0.002
+                    else:
+                        lr = 0.005
+                    for g in model.optimizer.param_groups:
+                        g['lr'] = lr
+
+                if epoch + 1 == 300:
+                    for g in model.optimizer.param_groups:
+                        g['lr'] = 0.002
+
+        eval_results = evaluator.fast_eval()
+        print(eval_results)
+        # with open(os.path.join(args.model_destination, 'results.pkl'), 'w') as f:
+        #     pickle.dump(eval_results, f)
+        with open(os.path.join(model_destination, 'history.pkl'), 'wb') as f:
+            pickle.dump(training_history, f)
+    finally:  # the workers and spill directories of the loaders are freed even when training fails
+        for loader in (train_input_gen, val_input_gen):
+            if isinstance(loader, TriadLoader):
+                loader.close()
     print("Done!")
 
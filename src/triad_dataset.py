@@ -0,0 +1,220 @@
+"""Compiled triad dataset.
+
+The triads of a document do not change between epochs, so they can be computed once and
+read back instead of being generated from the corpus every epoch. compile_triad_dataset
+writes the mention table and triad indexes of every document (see TriadBatch) to shards
+of fixed-width binary arrays. TriadDataset memory-maps the shards and yields the same
+data as DataGen.generate_triad_input, without any feature extraction.
+
+Layout of a dataset directory:
+    meta.json                          format version, sizes and the keys of the corpus and the vocabularies
+    doc_ids.txt                        one doc_id per line
+    documents.int64                    (n_docs, 5) shard, start and end mention, start and end triad
+    shard_<nnn>/<name>.<dtype>         mention arrays (start, end, speaker, coref, words, pos),
+                                       triads (n, 3) and labels (n, 3) of the documents of the shard
+"""
+from __future__ import print_function
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from src.build_data import TriadBatch, MAX_DISTANCE
+from src.compact_corpus import CODED_COLUMNS, FRAME_COLUMNS
+from src.token_store import read_lines, write_lines, read_json, write_json, array_file, open_array
+
+DATASET_VERSION = 1
+MENTION_ARRAYS = [('start', np.int64), ('end', np.int64), ('speaker', np.int64), ('coref', np.int64),
+                  ('words', np.int32), ('pos', np.int32)]
+TRIAD_ARRAYS = [('triads', np.int32), ('labels', np.int8)]
+CORPUS_ARRAYS = ['word_nb', 'doc_ranges', 'mention_ranges', 'mention_starts', 'mention_ends', 'mention_clusters']
+
+_compile_state = None  # (DataGen, max_distance) of the compile workers, inherited when they are forked
+
+
+def get_vocabulary_key(word_vocab, pos_vocab):
+    """key of the codes of a word and a pos vocabulary, a compiled dataset is only valid for these codes"""
+    md5 = hashlib.md5()
+    for vocab in (word_vocab, pos_vocab):
+        state = dict((key, value) for key, value in vars(vocab).items() if key not in ('codes', 'bags'))
+        md5.update(json.dumps(state, sort_keys=True, default=str).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def get_corpus_key(documents):
+    """key of the content of a corpus: the columns of a data frame, or the codes, vocabularies and mention
+       arrays of a compact corpus. A compiled dataset is only valid for this content
+    """
+    md5 = hashlib.md5()
+    if documents.df is not None:
+        frame = documents.df[[column for column in FRAME_COLUMNS if column in documents.df.columns]]
+        md5.update(pd.util.hash_pandas_object(frame, index=False).values)
+        return md5.hexdigest()
+    for column in CODED_COLUMNS:
+        md5.update('\n'.join(str(value) for value in documents.vocabs[column]).encode('utf-8'))
+        md5.update(np.ascontiguousarray(documents.codes[column]))
+    for name in CORPUS_ARRAYS:
+        md5.update(np.ascontiguousarray(getattr(documents, name)))
+    return md5.hexdigest()
+
+
+def compile_document(doc_id):
+    """Pool task. (doc_id, mention arrays, triads, labels) of a document, None if it has no triads"""
+    gen, max_distance = _compile_state
+    datum = gen.get_triad_datum(doc_id, max_distance, compact=True)
+    if not datum or not len(datum[1]):
+        return None
+    X, Y = datum
+    return doc_id, X.mentions, X.triads, Y.astype(np.int8)
+
+
+def compile_triad_dataset(gen, dataset_dir, max_distance=MAX_DISTANCE, threads=4, docs_per_shard=1000):
+    """Write the triads of all documents of a DataGen to dataset_dir. Returns the TriadDataset"""
+    global _compile_state
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+    meta_file = os.path.join(dataset_dir, 'meta.json')
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)  # a dataset without meta.json is incomplete
+
+    start_time = time.time()
+    _compile_state = (gen, max_distance)
+    pool = multiprocessing.Pool(threads) if threads > 1 else None
+    doc_ids = list(gen.documents.doc_ids)
+    results = pool.imap(compile_document, doc_ids, chunksize=4) if pool else (compile_document(doc_id) for doc_id in doc_ids)
+
+    compiled_ids = []
+    documents = []
+    files = {}
+    shard = -1
+    n_mentions = n_triads = 0
+    word_shape = None
+    try:
+        for result in results:
+            if result is None:
+                continue
+            doc_id, mentions, triads, labels = result
+            if len(compiled_ids) % docs_per_shard == 0:
+                for f in files.values():
+                    f.close()
+                shard += 1
+                shard_dir = os.path.join(dataset_dir, 'shard_%03d' % shard)
+                if not os.path.isdir(shard_dir):
+                    os.makedirs(shard_dir)
+                files = dict((name, open(array_file(shard_dir, name, dtype), 'wb')) for name, dtype in MENTION_ARRAYS + TRIAD_ARRAYS)
+                n_mentions = n_triads = 0
+            arrays = dict(mentions, triads=triads, labels=labels)
+            for name, dtype in MENTION_ARRAYS + TRIAD_ARRAYS:
+                np.ascontiguousarray(arrays[name], dtype=dtype).tofile(files[name])
+            word_shape = mentions['words'].shape[1:]
+            compiled_ids.append(doc_id)
+            documents.append([shard, n_mentions, n_mentions + len(mentions['start']), n_triads, n_triads + len(triads)])
+            n_mentions += len(mentions['start'])
+            n_triads += len(triads)
+    finally:
+        for f in files.values():
+            f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _compile_state = None
+
+    write_lines(os.path.join(dataset_dir, 'doc_ids.txt'), compiled_ids)
+    documents = np.array(documents, dtype=np.int64).reshape(-1, 5)
+    documents.tofile(os.path.join(dataset_dir, 'documents.int64'))
+    write_json(meta_file, {'version': DATASET_VERSION, 'n_docs': len(compiled_ids), 'n_shards': shard + 1,
+                           'n_triads': int((documents[:, 4] - documents[:, 3]).sum()),
+                           'word_shape': list(word_shape) if word_shape is not None else [],
+                           'max_distance': max_distance, 'corpus_docs': sorted(doc_ids),
+                           'corpus_key': get_corpus_key(gen.documents),
+                           'vocabulary_key': get_vocabulary_key(gen.word_indexes, gen.pos_tags)})
+    print("triad dataset %s: %d documents, %d triads compiled in %ds" % (
+        dataset_dir, len(compiled_ids), int((documents[:, 4] - documents[:, 3]).sum()), int(time.time() - start_time)))
+    return TriadDataset(dataset_dir)
+
+
+def is_compiled(gen, dataset_dir, max_distance=MAX_DISTANCE):
+    """whether dataset_dir holds the triads of the corpus and vocabularies of a DataGen"""
+    meta_file = os.path.join(dataset_dir, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return False
+    meta = read_json(meta_file)
+    return (meta['version'] == DATASET_VERSION and meta['max_distance'] == max_distance
+            and meta['vocabulary_key'] == get_vocabulary_key(gen.word_indexes, gen.pos_tags)
+            and meta['corpus_docs'] == sorted(gen.documents.doc_ids)
+            and meta.get('corpus_key') == get_corpus_key(gen.documents))
+
+
+def open_triad_dataset(gen, dataset_dir, max_distance=MAX_DISTANCE, threads=4, recompile=False):
+    """TriadDataset of a DataGen in dataset_dir, compiled if it is missing or out of date"""
+    if recompile or not is_compiled(gen, dataset_dir, max_distance):
+        return compile_triad_dataset(gen, dataset_dir, max_distance=max_distance, threads=threads)
+    return TriadDataset(dataset_dir)
+
+
+class TriadDataset(object):
+    """Memory-mapped compiled triad dataset"""
+    def __init__(self, dataset_dir):
+        meta = read_json(os.path.join(dataset_dir, 'meta.json'))
+        if meta['version'] != DATASET_VERSION:
+            raise ValueError("triad dataset %s has version %s, expected %d" % (dataset_dir, meta['version'], DATASET_VERSION))
+        self.dataset_dir = dataset_dir
+        self.doc_ids = np.array(read_lines(os.path.join(dataset_dir, 'doc_ids.txt')), dtype=object)
+        self.documents = np.fromfile(os.path.join(dataset_dir, 'documents.int64'), dtype=np.int64).reshape(-1, 5)
+        word_shape = tuple(meta['word_shape'])
+        shapes = {'words': word_shape, 'pos': word_shape[:1], 'triads': (3,), 'labels': (3,)}
+        self.shards = []
+        for shard in range(meta['n_shards']):
+            shard_dir = os.path.join(dataset_dir, 'shard_%03d' % shard)
+            arrays = {}
+            for name, dtype in MENTION_ARRAYS + TRIAD_ARRAYS:
+                arrays[name] = open_array(array_file(shard_dir, name, dtype), dtype).reshape((-1,) + shapes.get(name, ()))
+            self.shards.append(arrays)
+        assert len(self.doc_ids) == len(self.documents) == meta['n_docs']
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def get(self, i, compact=True):
+        """[X, Y] of the i-th document. X is a TriadBatch of views of the shard, or the 15 input arrays"""
+        shard, mention_start, mention_end, triad_start, triad_end = self.documents[i].tolist()
+        arrays = self.shards[shard]
+        mentions = dict((name, arrays[name][mention_start:mention_end]) for name, _ in MENTION_ARRAYS)
+        X = TriadBatch(mentions, arrays['triads'][triad_start:triad_end])
+        Y = arrays['labels'][triad_start:triad_end].astype(np.int64)
+        return [X if compact else X.expand(), Y]
+
+    def get_order(self, shuffle='document', file_batch=100):
+        """document order of an epoch. shuffle: 'document', 'batch' (shuffle runs of file_batch stored
+           documents, which keeps reads sequential) or None
+        """
+        order = np.arange(len(self))
+        if shuffle == 'document':
+            np.random.shuffle(order)
+        elif shuffle == 'batch':
+            batches = [order[i:i + file_batch] for i in range(0, len(order), file_batch)]
+            np.random.shuffle(batches)
+            order = np.concatenate(batches) if batches else order
+        elif shuffle is not None:
+            raise ValueError("unknown shuffle %s" % shuffle)
+        return order
+
+    def generate_triad_input(self, file_batch=100, looping=True, compact=True, shuffle='document'):
+        """Yield deques of file_batch [X, Y] data, like DataGen.generate_triad_input.
+           looping: without looping, yield the whole data set once
+        """
+        data_q = deque()
+        while True:
+            for i in self.get_order(shuffle if looping else None, file_batch):
+                data_q.append(self.get(i, compact))
+                if looping and len(data_q) == file_batch:
+                    yield data_q
+                    data_q = deque()
+            if not looping:
+                yield data_q
+                break
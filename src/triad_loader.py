@@ -0,0 +1,374 @@
+"""Worker processes generating triad input, with an explicit lifecycle"""
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from src.batch_transport import SharedSlots, get_nbytes, spill, unpack
+from src.build_data import count_triads, MAX_DISTANCE, NEIGHBORHOOD
+
+
+def read_rss(pid):
+    """resident memory in MB of a process, None if it is not available"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def read_private_memory(pid):
+    """memory in MB only a process maps (not shared with its parent or the other workers), its RSS if
+       this is not available
+    """
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith('Private_')) / 1024.
+    except (IOError, OSError):
+        return read_rss(pid)
+
+
+class TriadLoader(object):
+    """Generates the triad input of a DataGen in worker processes, see DataGen.generate_triad_input.
+
+       Workers are started by start() and stopped by close(), or by a with statement. Iterating yields
+       deques of file_batch data; without looping, the whole data set is yielded once.
+       Each worker has its own task queue holding at most prefetch tasks, so the data a worker can hold
+       is bounded. Workers that crash are restarted and their tasks queued again, and a
+       worker whose private memory grows over max_worker_memory (MB) is replaced by a fresh fork after
+       its current document. An exception while processing a document is raised in the consumer.
+       The prefetch queue is bounded by max_queue_bytes: a worker waits until its datum fits, and
+       a datum over spill_bytes (max_queue_bytes / 4 by default) is written to a temporary memory-mapped
+       file instead of being queued.
+       Documents are scheduled by their estimated number of triads: a document with more than chunk_triads
+       triads is split into chunks of mentions, the biggest tasks of each batch go first, and each one goes
+       to the worker with the least work assigned. utilization() reports how busy the workers are.
+    """
+    def __init__(self, gen, file_batch=100, looping=True, test_data=False, threads=4, compact=False,
+                 shared_memory=False, max_distance=MAX_DISTANCE, prefetch=None, max_worker_memory=None,
+                 max_restarts=10, max_queue_bytes=2 ** 30, spill_bytes=None, chunk_triads=20000):
+        self.gen = gen
+        self.file_batch = 1 if test_data else file_batch  # test data is yielded one file at a time
+        self.looping = looping
+        self.test_data = test_data
+        self.threads = threads
+        self.compact = compact
+        self.shared_memory = shared_memory
+        self.max_distance = max_distance
+        self.prefetch = prefetch or (self.file_batch + threads - 1) // threads + 1  # enough for the next batch
+        self.max_worker_memory = max_worker_memory
+        self.max_restarts = max_restarts
+        self.max_queue_bytes = max_queue_bytes
+        self.spill_bytes = spill_bytes or max_queue_bytes // 4
+        assert self.spill_bytes <= max_queue_bytes
+        self.doc_ids = list(gen.documents.doc_ids)
+        self.chunk_triads = chunk_triads
+        self.tasks, self.costs = self.get_tasks()
+        self.workers = []
+        self.running = False
+        self.exhausted = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def start(self):
+        if self.running:
+            return self
+        # queues and shared memory slots are created before the workers are forked
+        self.slots = SharedSlots(self.file_batch + 2 * self.threads, n_workers=self.threads) if self.shared_memory else None
+        self.queued = multiprocessing.Array('q', self.threads)  # bytes in the queue from each worker
+        self.spill_dir = tempfile.mkdtemp(prefix='triads_')
+        self.times = multiprocessing.RawArray('d', 2 * self.threads)  # busy and idle seconds of each worker
+        self.wait_time = 0.
+        self.n_spilled = 0
+        self.pending = deque(self.get_epoch())
+        self.assigned = [deque() for _ in range(self.threads)]  # documents sent to each worker and not done
+        self.doc_qs = [None] * self.threads
+        self.out_qs = [None] * self.threads
+        self.next_slot = 0  # the next worker to read from
+        self.workers = [None] * self.threads
+        self.done = set()
+        self.restarts = 0
+        for slot in range(self.threads):
+            self.start_worker(slot)
+        self.running = True
+        self.exhausted = False
+        self.dispatch()
+        return self
+
+    def close(self):
+        """Stop the workers and free the queues. The loader can be started again"""
+        if not self.running:
+            return
+        self.running = False
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        for q in self.doc_qs + self.out_qs:
+            q.cancel_join_thread()  # items left in the queues are dropped
+            q.close()
+        if self.slots is not None:
+            self.slots.release()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.workers = []
+
+    def get_tasks(self):
+        """(doc index, chunk, n_chunks) tasks and their estimated cost, the number of triads plus mentions.
+           The first mention is repeated in the triads. Test data are not split
+        """
+        tasks = []
+        costs = {}
+        for index, n_mentions in enumerate(self.gen.documents.mention_counts().tolist()):
+            n_triads = count_triads(n_mentions + (NEIGHBORHOOD != -1), self.max_distance)
+            n_chunks = 1 if self.test_data else max(1, min(n_triads // self.chunk_triads, n_mentions))
+            for chunk in range(n_chunks):
+                tasks.append((index, chunk, n_chunks))
+                costs[index, chunk, n_chunks] = (n_triads + n_mentions) / float(n_chunks)
+        return tasks, costs
+
+    def get_epoch(self):
+        """tasks of an epoch. Training tasks are shuffled, then the tasks of each batch are sorted by cost
+           so the biggest start first. Otherwise all the tasks are sorted by cost
+        """
+        if self.test_data or not self.looping:
+            return sorted(self.tasks, key=self.costs.get, reverse=True)
+        order = np.random.permutation(len(self.tasks))
+        epoch = []
+        for i in range(0, len(order), self.file_batch):
+            epoch += sorted([self.tasks[j] for j in order[i:i + self.file_batch]], key=self.costs.get, reverse=True)
+        return epoch
+
+    def start_worker(self, slot):
+        # a worker that dies while reading or writing a shared queue would keep its lock, so each worker
+        # has its own queues, which are replaced with it
+        self.doc_qs[slot] = multiprocessing.Queue()
+        self.out_qs[slot] = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=self.work, args=(slot, self.doc_qs[slot], self.out_qs[slot]))
+        worker.daemon = True
+        worker.start()
+        self.workers[slot] = worker
+
+    def restart_worker(self, slot):
+        """Replace the worker of a slot and its queues, its tasks are queued again first"""
+        worker = self.workers[slot]
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+        for q in (self.doc_qs[slot], self.out_qs[slot]):
+            q.cancel_join_thread()
+            q.close()
+        self.pending.extendleft(reversed(self.assigned[slot]))
+        self.assigned[slot].clear()
+        self.queued[slot] = 0  # its results left in its queue are dropped
+        if self.slots is not None:
+            self.slots.reclaim(slot)
+        self.start_worker(slot)
+
+    def work(self, slot, doc_q, out_q):
+        while True:
+            wait_start = time.time()
+            task = doc_q.get()
+            start = time.time()
+            index, chunk, n_chunks = task
+            try:
+                datum = self.gen.get_triad_datum(self.doc_ids[index], self.max_distance, test_data=self.test_data,
+                                                 compact=self.compact, chunk=(chunk, n_chunks) if n_chunks > 1 else None)
+            except Exception:
+                out_q.put(('error', slot, task, 0, traceback.format_exc()))
+                return
+            waited = 0.
+            nbytes = 0
+            if datum is None:
+                message = None
+            elif get_nbytes(datum) > self.spill_bytes:
+                message = spill(datum, self.spill_dir)
+            else:
+                nbytes = get_nbytes(datum)
+                waited = self.reserve(slot, nbytes)
+                message = self.slots.pack(datum, slot) if self.slots is not None else ('pickled', datum)
+            out_q.put(('done', slot, task, nbytes, message))
+            self.times[2 * slot] += time.time() - start - waited
+            self.times[2 * slot + 1] += start - wait_start + waited
+            if self.max_worker_memory and read_private_memory(os.getpid()) > self.max_worker_memory:
+                out_q.put(('exit', slot, None, 0, None))  # after all its results
+                return
+
+    def reserve(self, slot, nbytes):
+        """worker side: wait until nbytes fit in the prefetch queue. A datum always fits in an empty queue.
+           Returns the seconds waited
+        """
+        start = time.time()
+        while True:
+            with self.queued.get_lock():
+                queued = sum(self.queued)
+                if queued == 0 or queued + nbytes <= self.max_queue_bytes:
+                    self.queued[slot] += nbytes
+                    return time.time() - start
+            time.sleep(0.01)
+
+    def dispatch(self):
+        """Send the next tasks to the workers with less than prefetch tasks, each to the one with the least
+           estimated cost assigned. When looping, the next epoch is queued when the current one has been dispatched
+        """
+        while True:
+            slots = [slot for slot in range(self.threads) if len(self.assigned[slot]) < self.prefetch]
+            if not slots:
+                return
+            if not self.pending:
+                if not self.looping:
+                    return
+                self.pending.extend(self.get_epoch())
+            slot = min(slots, key=lambda slot: sum(self.costs[task] for task in self.assigned[slot]))
+            task = self.pending.popleft()
+            self.assigned[slot].append(task)
+            self.doc_qs[slot].put(task)
+
+    def check_workers(self):
+        """Restart the workers that crashed"""
+        for slot, worker in enumerate(self.workers):
+            if worker.is_alive() or worker.exitcode == 0:  # a worker exits normally after sending 'exit'
+                continue
+            self.restarts += 1
+            print("triad worker %d exited with code %s, restarting it" % (worker.pid, worker.exitcode))
+            if self.restarts > self.max_restarts:
+                self.close()
+                raise RuntimeError("triad workers crashed %d times" % self.restarts)
+            self.restart_worker(slot)
+        self.dispatch()
+
+    def memory_usage(self, private=False):
+        """resident memory in MB of each worker. private: only the memory it does not share, e.g. without
+           the pages of the corpus it reads
+        """
+        return [read_private_memory(worker.pid) if private else read_rss(worker.pid) for worker in self.workers]
+
+    def queue_fill(self):
+        """bytes waiting in the prefetch queue, and their fraction of max_queue_bytes"""
+        queued = sum(self.queued)
+        return queued, queued / float(self.max_queue_bytes)
+
+    def utilization(self):
+        """fraction of its time each worker spent generating data, instead of waiting for tasks or queue
+           room, and the seconds the consumer waited for batches
+        """
+        times = np.frombuffer(self.times, dtype=np.float64).reshape(-1, 2)
+        return (times[:, 0] / np.maximum(times.sum(axis=1), 1e-9)).tolist(), self.wait_time
+
+    def __next__(self):
+        if self.exhausted:
+            raise StopIteration
+        if not self.running:
+            self.start()
+        if self.slots is not None:
+            self.slots.release()  # the consumer is done with the previous batch
+        start = time.time()
+        data_q = self.get_batch()
+        self.wait_time += time.time() - start
+        return data_q
+
+    def receive(self, timeout=1):
+        """next message of the workers, in turn. None if there is none within timeout seconds"""
+        deadline = time.time() + timeout
+        while True:
+            for i in range(self.threads):
+                slot = (self.next_slot + i) % self.threads
+                try:
+                    message = self.out_qs[slot].get_nowait()
+                except queue.Empty:
+                    continue
+                self.next_slot = slot + 1
+                return message
+            if time.time() > deadline:
+                return None
+            time.sleep(0.005)
+
+    def next_datum(self):
+        """(task, datum) of the next finished task, datum is None for a skipped document.
+           None when the whole data set is done, without looping
+        """
+        while True:
+            if not self.looping and len(self.done) == len(self.tasks):  # the whole data set
+                self.exhausted = True
+                return None
+            self.check_workers()
+            message = self.receive()
+            if message is None:
+                continue
+            kind, slot, task, nbytes, datum = message
+            if kind == 'error':
+                self.close()
+                raise RuntimeError("triad worker failed on %s:\n%s" % (self.doc_ids[task[0]], datum))
+            if kind == 'exit':
+                self.restart_worker(slot)
+                continue
+            if task in self.assigned[slot]:
+                self.assigned[slot].remove(task)
+            if nbytes:
+                with self.queued.get_lock():
+                    self.queued[slot] = max(self.queued[slot] - nbytes, 0)
+            if not self.looping:
+                if task in self.done:  # sent again after a crash
+                    if self.slots is not None:
+                        self.slots.discard(datum)
+                    continue
+                self.done.add(task)
+            if datum is None:
+                return task, None
+            if datum[0] == 'spilled':
+                self.n_spilled += 1
+            return task, self.slots.unpack(datum) if self.slots is not None else unpack(datum)
+
+    def get_batch(self):
+        """deque of the next file_batch data, or of the rest of the data set without looping"""
+        data_q = deque()
+        while True:
+            result = self.next_datum()
+            if result is None:
+                return data_q
+            task, datum = result
+            if datum is None:  # skipped document
+                continue
+            data_q.append(datum)
+            if self.looping and len(data_q) == self.file_batch:
+                return data_q
+
+    def documents(self):
+        """Without looping, yield (doc_id, datum) of every document once, in the order they are finished.
+           datum is None for a skipped document. With shared_memory, a datum is only valid until the next one
+        """
+        assert not self.looping, "a looping loader has no end"
+        if not self.running:
+            self.start()
+        while True:
+            if self.slots is not None:
+                self.slots.release()
+            start = time.time()
+            result = self.next_datum()
+            self.wait_time += time.time() - start
+            if result is None:
+                return
+            task, datum = result
+            yield self.doc_ids[task[0]], datum
+
+    next = __next__  # python 2
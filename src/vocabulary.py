@@ -0,0 +1,231 @@
+"""Token vocabularies of the word and pos tag inputs"""
+from __future__ import print_function
+import io
+import json
+import os
+import pickle
+import zlib
+import numpy as np
+import pandas as pd
+
+WORD_VOCAB_FILE = 'word_vocab.txt'
+POS_VOCAB_FILE = 'pos_vocab.txt'
+
+
+class Vocabulary(object):
+    """Maps tokens to integer codes, and encodes whole token sequences at once.
+       tokens: tokens in code order, tokens[i] has code i + first_code
+       unknown_code: code of unknown tokens
+       first_letter: an unknown token gets the code of its first letter, if that is a token
+    """
+    def __init__(self, tokens, unknown_code, first_code=1, first_letter=False):
+        self.tokens = list(tokens)
+        self.first_code = first_code
+        self.unknown_code = unknown_code
+        self.first_letter = first_letter
+        self.codes = dict((token, i + first_code) for i, token in enumerate(self.tokens))
+        assert len(self.codes) == len(self.tokens), "duplicate tokens"
+
+    @classmethod
+    def from_word_indexes(cls, word_indexes):
+        """vocabulary of a {word: index} dict, unknown words fall back to their first letter, then UKN"""
+        words = sorted(word_indexes, key=word_indexes.get)
+        first_code = word_indexes[words[0]] if words else 1
+        assert all(word_indexes[word] == i + first_code for i, word in enumerate(words)), "word indexes are not contiguous"
+        return cls(words, word_indexes['UKN'], first_code=first_code, first_letter=True)
+
+    @classmethod
+    def from_pos_tags(cls, pos_tags):
+        """vocabulary of a pos tag list. Tag i has code i + 1, unknown tags get the index of UKN,
+           which is the code of the tag before it, as the trained models expect
+        """
+        return cls(pos_tags, list(pos_tags).index('UKN'), first_code=1)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.codes
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __getitem__(self, token):
+        """code of a token, known or not"""
+        return self.get_code(token)
+
+    def get_code(self, token, first_letter=None):
+        code = self.codes.get(token)
+        if code is None:
+            if first_letter is None:
+                first_letter = self.first_letter
+            code = self.codes.get(token[:1], self.unknown_code) if first_letter else self.unknown_code
+        return code
+
+    def encode(self, tokens, first_letter=None):
+        """int32 codes of a token sequence. Each distinct token is looked up once"""
+        token_codes, uniques = pd.factorize(np.asarray(tokens, dtype=object))
+        table = np.array([self.get_code(token, first_letter) for token in uniques], dtype=np.int32)
+        return table[token_codes] if len(token_codes) else np.zeros(0, dtype=np.int32)
+
+    def encode_lists(self, token_lists, first_letter=None):
+        """codes of several token sequences with one encode call. Returns a list of int32 arrays"""
+        lengths = [len(tokens) for tokens in token_lists]
+        tokens = [token for token_list in token_lists for token in token_list]
+        return np.split(self.encode(tokens, first_letter), np.cumsum(lengths)[:-1]) if lengths else []
+
+    def decode(self, codes):
+        tokens = np.array(self.tokens, dtype=object)
+        return tokens[np.asarray(codes) - self.first_code]
+
+    def add(self, tokens):
+        """Append new tokens after the existing ones, existing codes do not change. Returns the added tokens"""
+        added = []
+        for token in tokens:
+            if token not in self.codes:
+                self.codes[token] = len(self.tokens) + self.first_code
+                self.tokens.append(token)
+                added.append(token)
+        return added
+
+    def save(self, file_name):
+        """one json header line, then one token per line"""
+        with io.open(file_name, 'w', encoding='utf-8', newline='\n') as f:
+            header = {'first_code': self.first_code, 'unknown_code': self.unknown_code, 'first_letter': self.first_letter}
+            f.write(json.dumps(header) + '\n')
+            for token in self.tokens:
+                f.write(token + '\n')
+
+    @classmethod
+    def load(cls, file_name):
+        with io.open(file_name, encoding='utf-8', newline='\n') as f:
+            header = json.loads(f.readline())
+            tokens = [line[:-1] for line in f]
+        return cls(tokens, header['unknown_code'], first_code=header['first_code'], first_letter=header['first_letter'])
+
+
+class HashedVocabulary(object):
+    """Maps tokens to bags of hash buckets instead of a single code, so any word has a representation.
+       A word is hashed whole, and as the character n-grams of '<word>', like fastText. The input of a
+       hashed embedding is the sum of the bucket vectors.
+       n_buckets: size of the embedding table. Bucket 0 is padding
+       bag_size: buckets per token, the whole word first. Longer bags are truncated, shorter ones padded with 0
+    """
+    def __init__(self, n_buckets=2 ** 20, min_n=3, max_n=5, bag_size=24):
+        assert n_buckets > 1 and 0 < min_n <= max_n and bag_size > 0
+        self.n_buckets = n_buckets
+        self.min_n = min_n
+        self.max_n = max_n
+        self.bag_size = bag_size
+        self.first_code = 1
+        self.bags = {}  # token -> bag, tokens are hashed once per process
+
+    def __len__(self):
+        """number of non padding buckets, the table of an embedding has len + 1 rows"""
+        return self.n_buckets - 1
+
+    def __contains__(self, token):
+        return True
+
+    def get_bucket(self, text):
+        """bucket of a string. crc32 is stable across processes, unlike hash()"""
+        return 1 + zlib.crc32(text.encode('utf-8')) % (self.n_buckets - 1)
+
+    def get_bag(self, token):
+        bag = self.bags.get(token)
+        if bag is None:
+            bag = np.zeros(self.bag_size, dtype=np.int32)
+            buckets = [self.get_bucket(token)]
+            marked = '<' + token + '>'
+            for n in range(self.min_n, min(self.max_n, len(marked) - 1) + 1):  # the whole word is hashed already
+                buckets.extend(self.get_bucket('#' + marked[i:i + n]) for i in range(len(marked) - n + 1))
+            buckets = buckets[:self.bag_size]
+            bag[:len(buckets)] = buckets
+            self.bags[token] = bag
+        return bag
+
+    def get_code(self, token, first_letter=None):
+        return self.get_bag(token)
+
+    def encode(self, tokens, first_letter=None):
+        """(n tokens, bag_size) int32 buckets of a token sequence. first_letter is ignored, there are no unknown words"""
+        token_codes, uniques = pd.factorize(np.asarray(tokens, dtype=object))
+        if not len(token_codes):
+            return np.zeros((0, self.bag_size), dtype=np.int32)
+        table = np.stack([self.get_bag(token) for token in uniques])
+        return table[token_codes]
+
+    def encode_lists(self, token_lists, first_letter=None):
+        lengths = [len(tokens) for tokens in token_lists]
+        tokens = [token for token_list in token_lists for token in token_list]
+        return np.split(self.encode(tokens), np.cumsum(lengths)[:-1]) if lengths else []
+
+    def add(self, tokens):
+        """nothing to add, every token is hashed"""
+        return []
+
+    def save(self, file_name):
+        with io.open(file_name, 'w', encoding='utf-8', newline='\n') as f:
+            header = {'hashed': True, 'n_buckets': self.n_buckets, 'min_n': self.min_n, 'max_n': self.max_n,
+                      'bag_size': self.bag_size}
+            f.write(json.dumps(header) + '\n')
+
+    @classmethod
+    def load(cls, file_name):
+        with io.open(file_name, encoding='utf-8', newline='\n') as f:
+            header = json.loads(f.readline())
+        return cls(header['n_buckets'], min_n=header['min_n'], max_n=header['max_n'], bag_size=header['bag_size'])
+
+
+def load_vocabulary(file_name):
+    """Vocabulary or HashedVocabulary saved in file_name"""
+    with io.open(file_name, encoding='utf-8', newline='\n') as f:
+        header = json.loads(f.readline())
+    if header.get('hashed'):
+        return HashedVocabulary.load(file_name)
+    return Vocabulary.load(file_name)
+
+
+def trim_vocabulary(word_vocab, embedding_matrix, keep_words):
+    """Keep the words of keep_words, the special tokens and the single letters unknown words fall back to.
+       Kept words stay in their old order, and row 0 (padding) is kept.
+       Returns (vocabulary, embedding matrix) of the kept words
+    """
+    keep_words = set(keep_words) | set(['UKN', '_START_', '_END_'])
+    words = [word for word in word_vocab.tokens if word in keep_words or len(word) == 1]
+    old_codes = np.array([word_vocab.codes[word] for word in words], dtype=np.int64)
+    trimmed = Vocabulary(words, 0, first_code=word_vocab.first_code, first_letter=word_vocab.first_letter)
+    trimmed.unknown_code = trimmed.codes[word_vocab.tokens[word_vocab.unknown_code - word_vocab.first_code]]
+    rows = np.concatenate([np.arange(word_vocab.first_code), old_codes])
+    return trimmed, embedding_matrix[rows]
+
+
+def get_word_vocabulary(word_indexes):
+    """Vocabulary of a Vocabulary, HashedVocabulary or {word: index} dict"""
+    if isinstance(word_indexes, (Vocabulary, HashedVocabulary)):
+        return word_indexes
+    return Vocabulary.from_word_indexes(word_indexes)
+
+
+def get_pos_vocabulary(pos_tags):
+    """Vocabulary of a Vocabulary or pos tag list"""
+    if isinstance(pos_tags, Vocabulary):
+        return pos_tags
+    return Vocabulary.from_pos_tags(pos_tags)
+
+
+def save_vocabularies(model_dir, word_vocab, pos_vocab):
+    word_vocab.save(os.path.join(model_dir, WORD_VOCAB_FILE))
+    pos_vocab.save(os.path.join(model_dir, POS_VOCAB_FILE))
+
+
+def load_vocabularies(model_dir):
+    """(word vocabulary, pos vocabulary) of a model. Older models have pickled word_indexes and pos_tags"""
+    if os.path.isfile(os.path.join(model_dir, WORD_VOCAB_FILE)):
+        return (load_vocabulary(os.path.join(model_dir, WORD_VOCAB_FILE)),
+                Vocabulary.load(os.path.join(model_dir, POS_VOCAB_FILE)))
+    with open(os.path.join(model_dir, 'word_indexes.pkl'), 'rb') as f:
+        word_indexes = pickle.load(f)
+    with open(os.path.join(model_dir, 'pos_tags.pkl'), 'rb') as f:
+        pos_tags = pickle.load(f)
+    return get_word_vocabulary(word_indexes), get_pos_vocabulary(pos_tags)
@@ -1,4 +1,9 @@
 from __future__ import print_function
+import io
+import json
+import multiprocessing
+import os
+import time
 import numpy as np
 
 
@@ -14,16 +19,231 @@ def load_glove(gloveFile):
     print("Done.",len(model)," words loaded!")
     return model
 
+
+GLOVE_CACHE_VERSION = 1
+PARSE_BATCH = 10000  # lines parsed at once by a worker
+_glove_caches = {}  # glove_path -> (words, word index, vectors)
+
+
+def get_glove_cache_files(glove_path):
+    """(vectors, vocabulary, meta) files of the binary cache of a glove text file"""
+    base = os.path.splitext(glove_path)[0]
+    return base + '.npy', base + '.vocab', base + '.meta.json'
+
+
+def get_source_key(glove_path):
+    stat = os.stat(glove_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def find_line_chunks(file_name, n_chunks):
+    """[(begin, end)] byte ranges of about equal size, aligned to line boundaries"""
+    size = os.path.getsize(file_name)
+    bounds = [0]
+    with open(file_name, 'rb') as f:
+        for i in range(1, n_chunks):
+            f.seek(max(i * size // n_chunks, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(begin, end) for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+
+
+def read_chunk_lines(file_name, begin, end):
+    """non-empty lines of a byte range"""
+    with open(file_name, 'rb') as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    return [line for line in data.split(b'\n') if line.strip()]
+
+
+def parse_glove_lines(lines, dim):
+    """(words, float32 vectors) of glove lines. Lines are split from the right, so words containing spaces are kept"""
+    words = []
+    values = []
+    for line in lines:
+        line = line.rstrip()
+        if line.count(b' ') == dim:
+            word, vector = line.split(b' ', 1)
+        else:  # the word contains spaces
+            fields = line.rsplit(b' ', dim)
+            word, vector = fields[0], b' '.join(fields[1:])
+        words.append(word.decode('utf-8'))
+        values.append(vector)
+    vectors = np.fromstring(b' '.join(values), dtype=np.float32, sep=' ')
+    if len(vectors) != len(lines) * dim:
+        raise ValueError("glove lines with other than %d values near %s" % (dim, words[0]))
+    return words, vectors.reshape(len(lines), dim)
+
+
+def count_glove_chunk(task):
+    """Pool task. Number of non-empty lines of a chunk, as read_chunk_lines splits it, counted from the
+       first byte of each line instead of splitting the chunk into lines
+    """
+    glove_path, begin, end = task
+    with open(glove_path, 'rb') as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    codes = np.frombuffer(data, dtype=np.uint8)
+    if not len(codes):
+        return 0
+    line_starts = np.concatenate([[0], np.flatnonzero(codes[:-1] == ord(b'\n')) + 1])
+    # a line starting with a byte above ' ' is not blank. Others may be blank or whitespace only, like ' \n',
+    # which read_chunk_lines skips
+    if (codes[line_starts] <= ord(b' ')).any():
+        return len([line for line in data.split(b'\n') if line.strip()])
+    return len(line_starts)
+
+
+def parse_glove_chunk(task):
+    """Pool task. Parse the lines of a chunk.
+       With vectors_file, the vectors are written to rows first_row... of the .npy file and the words are returned.
+       Otherwise (words, rows, vectors) of the lines among the first K + 1, or whose word is selected, are returned.
+    """
+    glove_path, begin, end, first_row, dim, vectors_file, K, selected = task
+    lines = read_chunk_lines(glove_path, begin, end)
+    out = np.load(vectors_file, mmap_mode='r+') if vectors_file else None
+    words = []
+    rows = []
+    vectors = []
+    for i in range(0, len(lines), PARSE_BATCH):
+        batch_words, batch_vectors = parse_glove_lines(lines[i:i + PARSE_BATCH], dim)
+        row = first_row + i
+        if out is not None:
+            out[row:row + len(batch_words)] = batch_vectors
+            words += batch_words
+            continue
+        for j, word in enumerate(batch_words):
+            if row + j <= K or word in selected:
+                words.append(word)
+                rows.append(row + j)
+                vectors.append(batch_vectors[j])
+    if out is not None:
+        out.flush()
+        return words
+    return words, rows, vectors
+
+
+def run_tasks(function, tasks, threads):
+    """results of function over tasks, in order, with a process pool"""
+    if threads > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(threads)
+        try:
+            return list(pool.imap(function, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    return [function(task) for task in tasks]
+
+
+def plan_glove_chunks(glove_path, threads, chunks_per_worker=4):
+    """Returns (dim, n_words, [(glove_path, begin, end, first_row)]): line aligned chunks with their first row"""
+    dim = None
+    with open(glove_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                dim = len(line.rstrip().split(b' ')) - 1
+                break
+    chunks = find_line_chunks(glove_path, threads * chunks_per_worker)
+    counts = run_tasks(count_glove_chunk, [(glove_path, begin, end) for begin, end in chunks], threads)
+    first_rows = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).tolist()
+    return dim, first_rows[-1], [(glove_path, begin, end, first_row) for (begin, end), first_row in zip(chunks, first_rows)]
+
+
+def convert_glove(glove_path, threads=None):
+    """Write the vectors of a glove text file as a float32 .npy matrix, and the words, one per line,
+       in the order of the text file. Chunks of the file are parsed in parallel, straight into the matrix.
+    """
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    vectors_file, vocab_file, meta_file = get_glove_cache_files(glove_path)
+    start = time.time()
+    dim, n_words, chunks = plan_glove_chunks(glove_path, threads)
+
+    tmp_file = vectors_file[:-len('.npy')] + '.tmp.npy'
+    vectors = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(n_words, dim or 0))
+    del vectors  # workers open the file themselves
+    tasks = [chunk + (dim, tmp_file, None, None) for chunk in chunks]
+    with io.open(vocab_file + '.tmp', 'w', encoding='utf-8', newline='\n') as vocab:
+        for words in run_tasks(parse_glove_chunk, tasks, threads):
+            for word in words:
+                vocab.write(word + '\n')
+    os.rename(tmp_file, vectors_file)
+    os.rename(vocab_file + '.tmp', vocab_file)
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump({'version': GLOVE_CACHE_VERSION, 'source': get_source_key(glove_path),
+                   'n_words': n_words, 'dim': dim}, f)
+    os.rename(meta_file + '.tmp', meta_file)  # renamed last and at once, marks the cache as complete
+    print("Converted %d glove vectors to %s in %.1fs with %d processes" % (
+        n_words, vectors_file, time.time() - start, threads))
+
+
+def parse_glove_selection(glove_path, tokens, K, threads=None):
+    """build_vocab straight from the text file, without the binary cache:
+       vectors of the K + 1 first words, <s>, </s> and the tokens, parsed in parallel
+    """
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    selected = set(tokens) | set(['<s>', '</s>'])
+    dim, _, chunks = plan_glove_chunks(glove_path, threads)
+    tasks = [chunk + (dim, None, K, selected) for chunk in chunks]
+    word_vec = {}
+    others = {}
+    for words, rows, vectors in run_tasks(parse_glove_chunk, tasks, threads):
+        for word, row, vector in zip(words, rows, vectors):
+            if row <= K:
+                word_vec[word] = vector
+            else:
+                others[word] = vector
+    for word in others:
+        if word not in word_vec:
+            word_vec[word] = others[word]
+    print("vocab size: %d " % len(word_vec))
+    return word_vec
+
+
+def load_glove_cache(glove_path):
+    """Returns (words, word index, vectors) of a glove file. The vectors are memory-mapped from the binary cache,
+       which is built from the text file when it is missing or older than the text file.
+       If a word occurs more than once, the index points at its last vector, like parsing the text file did.
+    """
+    if glove_path in _glove_caches:
+        return _glove_caches[glove_path]
+    vectors_file, vocab_file, meta_file = get_glove_cache_files(glove_path)
+    meta = None
+    if os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            try:
+                meta = json.load(f)
+            except ValueError:  # e.g. truncated by a crash, the cache is rebuilt
+                print("Ignoring unreadable glove cache %s" % meta_file)
+    if meta is None or meta['version'] != GLOVE_CACHE_VERSION or meta['source'] != get_source_key(glove_path):
+        convert_glove(glove_path)
+
+    with io.open(vocab_file, encoding='utf-8', newline='\n') as f:
+        words = [line[:-1] for line in f]
+    word_index = dict((word, i) for i, word in enumerate(words))
+    vectors = np.load(vectors_file, mmap_mode='r')
+    assert len(vectors) == len(words)
+    _glove_caches[glove_path] = words, word_index, vectors
+    return words, word_index, vectors
+
+
+def lookup_vectors(word_rows, vectors):
+    """{word: vector} of {word: row}, with one fancy indexing read of the memory-mapped vectors"""
+    words = list(word_rows)
+    rows = np.array([word_rows[word] for word in words], dtype=np.int64)
+    order = np.argsort(rows)  # read the file sequentially
+    selected = np.asarray(vectors[rows[order]])
+    return dict(zip([words[i] for i in order], selected))
+
+
 # The folliwing functions are adapted from https://github.com/facebookresearch/InferSent/blob/master/data.py
 
 def get_glove(word_dict, glove_path):
     # create word_vec with glove vectors
-    word_vec = {}
-    with open(glove_path) as f:
-        for line in f:
-            word, vec = line.split(' ', 1)
-            if word in word_dict:
-                word_vec[word] = np.array(list(map(float, vec.split())))
+    _, word_index, vectors = load_glove_cache(glove_path)
+    word_vec = lookup_vectors(dict((word, word_index[word]) for word in word_dict if word in word_index), vectors)
     print('Found {0}(/{1}) words with glove vectors'.format(
                 len(word_vec), len(word_dict)))
     return word_vec
@@ -42,25 +262,22 @@ def get_glove_k(K, glove_path):
     """create word_vec with k first glove vectors.
     Assuming word vectors are sorted by frequency. glove.840B.300d.txt satisfies
     """
-    k = 0
-    word_vec = {}
-    with open(glove_path) as f:
-        for line in f:
-            word, vec = line.split(' ', 1)
-            if k <= K:
-                word_vec[word] = np.fromstring(vec, sep=' ')
-                k += 1
-            if k > K:
-                if word in ['<s>', '</s>']:
-                    word_vec[word] = np.fromstring(vec, sep=' ')
-
-            if k > K and all([w in word_vec for w in ['<s>', '</s>']]):
-                break
-    return word_vec
+    words, word_index, vectors = load_glove_cache(glove_path)
+    word_rows = {}
+    for i, word in enumerate(words[:K + 1]):
+        word_rows[word] = i
+    for word in ['<s>', '</s>']:
+        if word not in word_rows and word in word_index:
+            word_rows[word] = word_index[word]
+    return lookup_vectors(word_rows, vectors)
 
 
-def build_vocab(tokens, glove_path, K=1000):
-    """build a vocabulary to include K most frequent tokens as long as those in passed-in tokens"""
+def build_vocab(tokens, glove_path, K=1000, use_cache=True):
+    """build a vocabulary to include K most frequent tokens as long as those in passed-in tokens
+       use_cache: read the vectors from the binary cache, building it if needed. Otherwise parse the text file
+    """
+    if not use_cache:
+        return parse_glove_selection(glove_path, tokens, K)
     word_vec = get_glove_k(K, glove_path)
     word_dict = {}
     for tok in tokens:
@@ -70,3 +287,9 @@ def build_vocab(tokens, glove_path, K=1000):
     print("vocab size: %d " % len(word_vec))
 
     return word_vec
+
+
+if __name__ == '__main__':
+    # one-time conversion: python -m src.word2vec glove.840B.300d.txt [processes]
+    import sys
+    convert_glove(sys.argv[1], threads=int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -14,6 +14,7 @@ import keras.backend as K
 
 from src.models import get_pre_ntm_model2, MAXLEN, get_combined_ntm_model, BATCH_SIZE
 from src.build_data import build_dataFrame, DataGen, group_data
+from src.vocabulary import save_vocabularies
 from predict import Evaluator
 
 
@@ -56,10 +57,7 @@ def main():
     train_gen = DataGen(build_dataFrame(args.train_dir, threads=4))
     train_input_gen = train_gen.generate_input(negative_ratio=args.neg_ratio, file_batch=100)
     print("Loaded training data")
-    with open(os.path.join(args.model_destination, 'word_indexes.pkl'), 'w') as f:
-        pickle.dump(train_gen.word_indexes, f)
-    with open(os.path.join(args.model_destination, 'pos_tags.pkl'), 'w') as f:
-        pickle.dump(train_gen.pos_tags, f)
+    save_vocabularies(args.model_destination, train_gen.word_indexes, train_gen.pos_tags)
 
     if args.val_dir is not None:
         if os.path.isfile(os.path.join(args.val_dir, 'eval_data.pkl')):
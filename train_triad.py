@@ -1,9 +1,14 @@
 """Train the triad model"""
 import argparse
 import os
-import pickle
+
+import numpy as np
 
 from src.build_data import build_dataFrame, DataGen
+from src.shared_corpus import SharedCorpus
+from src.token_store import ingest
+from src.triad_dataset import open_triad_dataset
+from src.vocabulary import HashedVocabulary, save_vocabularies
 
 
 def main():
@@ -40,31 +45,80 @@ def main():
                         default=False,
                         help="Use keras model")
 
+    parser.add_argument("--compact_corpus",
+                        action='store_true',
+                        default=False,
+                        help="Keep the training corpus as integer coded columns to save memory")
+
+    parser.add_argument("--shared_corpus",
+                        action='store_true',
+                        default=False,
+                        help="Keep the integer coded training corpus in shared memory, which the generation workers "
+                             "read instead of forked copies. Needs python 3.8 or later, not with --token_store")
+
+    parser.add_argument("--token_store",
+                        default=None,
+                        help="Directory of a memory-mapped token store to read the training corpus from. "
+                             "It is built from train_dir if it does not exist yet, new or changed files are ingested.")
+
+    parser.add_argument("--hashed_buckets",
+                        default=None,
+                        type=int,
+                        help="Hash words and their character n-grams into this many embedding buckets, "
+                             "instead of a GloVe vocabulary. Unknown words get their n-gram embeddings. pytorch only")
+
+    parser.add_argument("--dataset",
+                        default=None,
+                        help="Directory of a compiled triad dataset. The triads of the training corpus are computed once "
+                             "and stored there, it is compiled again when the corpus or the vocabularies change")
+
     args = parser.parse_args()
 
     assert os.path.isdir(args.train_dir)
     assert os.path.isdir(args.model_destination)
-
-    train_gen = DataGen(build_dataFrame(args.train_dir, threads=3))
-    with open(os.path.join(args.model_destination, 'word_indexes.pkl'), 'wb') as f:
-        pickle.dump(train_gen.word_indexes, f)
-    with open(os.path.join(args.model_destination, 'pos_tags.pkl'), 'wb') as f:
-        pickle.dump(train_gen.pos_tags, f)
-
-    if args.keras:  # keras model
-        from src.keras_models import train
-        train(train_gen=train_gen,
-              model_destination=args.model_destination,
-              val_dir=args.val_dir,
-              load_model=args.load_model,
-              epochs=args.epochs)
-    else:  # pytorch model
-        from src.torch_models import train
-        train(train_gen=train_gen,
-              model_destination=args.model_destination,
-              val_dir=args.val_dir,
-              load_model=args.load_model,
-              epochs=args.epochs)
+    assert args.hashed_buckets is None or not args.keras, "hashed embeddings need the pytorch model"
+    if args.shared_corpus and args.token_store is not None:
+        parser.error("--shared_corpus can not be used with --token_store, whose memory-mapped arrays the "
+                     "generation workers already share")
+
+    added_docs = []
+    if args.token_store is not None:
+        corpus, added_docs = ingest(args.train_dir, args.token_store, threads=3)
+    else:
+        corpus = build_dataFrame(args.train_dir, threads=3, compact=args.compact_corpus or args.shared_corpus)
+        if args.shared_corpus:
+            corpus = SharedCorpus(corpus)
+    try:
+        if args.hashed_buckets:
+            train_gen = DataGen(corpus, word_indexes=HashedVocabulary(args.hashed_buckets))
+        else:
+            train_gen = DataGen(corpus)
+        save_vocabularies(args.model_destination, train_gen.word_indexes, train_gen.pos_tags)
+        if train_gen.embedding_matrix is not None:
+            np.save(os.path.join(args.model_destination, 'embedding_matrix.npy'), train_gen.embedding_matrix)
+        dataset = None
+        if args.dataset is not None:
+            dataset = open_triad_dataset(train_gen, args.dataset, threads=3, recompile=bool(added_docs))
+
+        if args.keras:  # keras model
+            from src.keras_models import train
+            train(train_gen=train_gen,
+                  model_destination=args.model_destination,
+                  val_dir=args.val_dir,
+                  load_model=args.load_model,
+                  epochs=args.epochs,
+                  dataset=dataset)
+        else:  # pytorch model
+            from src.torch_models import train
+            train(train_gen=train_gen,
+                  model_destination=args.model_destination,
+                  val_dir=args.val_dir,
+                  load_model=args.load_model,
+                  epochs=args.epochs,
+                  dataset=dataset)
+    finally:  # the shared memory blocks are freed even when training fails or is interrupted
+        if isinstance(corpus, SharedCorpus):
+            corpus.close()
 
 
 if __name__ == "__main__":